@@ -1,4 +1,4 @@
-create table categories
+create table if not exists categories
 (
     id       serial
         primary key,
@@ -8,7 +8,7 @@ create table categories
     type     varchar(10)
 );
 
-create table questions
+create table if not exists questions
 (
     id          serial
         primary key,
@@ -24,7 +24,7 @@ create table questions
 );
 
 
-create table tunes
+create table if not exists tunes
 (
     id     serial
         primary key,
@@ -35,7 +35,7 @@ create table tunes
     words  text[]   default '{}'::text[]
 );
 
-create table customers
+create table if not exists customers
 (
     id       serial
         primary key,
@@ -45,7 +45,7 @@ create table customers
     status   smallint default 1
 );
 
-create table kbase
+create table if not exists kbase
 (
     id       serial
         primary key,
@@ -54,7 +54,7 @@ create table kbase
     title    text
 );
 
-create table playlist
+create table if not exists playlist
 (
     id          serial
         primary key,
@@ -67,7 +67,7 @@ create table playlist
     words       text[]
 );
 
-create table orders
+create table if not exists orders
 (
     id      serial
         primary key,
@@ -77,4 +77,3 @@ create table orders
     words   text[],
     url     text
 );
-
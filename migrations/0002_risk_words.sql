@@ -0,0 +1,11 @@
+create table if not exists risk_words
+(
+    id     serial
+        primary key,
+    phrase text               not null,
+    lemmas text[],
+    status smallint default 1 not null
+);
+
+alter table tunes
+    add column if not exists weight smallint default 1 not null;
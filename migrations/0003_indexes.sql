@@ -0,0 +1,39 @@
+-- Дубли customers.uid, созданные до upsert: плейлисты переносим на первую запись, остальные удаляем
+update playlist p
+set customer_id = d.keep_id
+from (select id, min(id) over (partition by uid) as keep_id
+      from customers
+      where uid is not null) d
+where p.customer_id = d.id
+  and d.id <> d.keep_id;
+
+delete
+from customers c
+    using customers k
+where c.uid = k.uid
+  and c.id > k.id;
+
+-- Поиск клиента по chat_id и upsert ON CONFLICT (uid)
+create unique index if not exists customers_uid_uindex
+    on customers (uid);
+
+-- Выбор трека по жанру
+create index if not exists tunes_genre_active_index
+    on tunes (genre)
+    where status = 1;
+
+-- Список сохраненных плейлистов клиента с keyset-пагинацией по id
+create index if not exists playlist_customer_id_id_saved_index
+    on playlist (customer_id, id)
+    where status = 3 and url is not null;
+
+-- Ответы базы знаний по кнопке и список кнопок по type
+create index if not exists kbase_title_index
+    on kbase (title);
+
+create index if not exists kbase_type_index
+    on kbase (type);
+
+-- Загрузка вопросов каталога по категориям
+create index if not exists questions_category_id_index
+    on questions (category_id);
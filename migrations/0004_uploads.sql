@@ -0,0 +1,13 @@
+-- Загруженные файлы по содержимому: один файл на sha256 и счетчик ссылок на него
+create table if not exists uploads
+(
+    sha256     varchar(64)
+        primary key,
+    path       text                    not null,
+    size       bigint                  not null,
+    refs       integer   default 0     not null,
+    created_at timestamp default now() not null
+);
+
+create unique index if not exists uploads_path_uindex
+    on uploads (path);
@@ -0,0 +1,17 @@
+-- Кэш результатов генерации: key - хэш жанра и отсортированного набора слов
+alter table orders
+    add column if not exists key varchar(32);
+
+alter table orders
+    add column if not exists hits integer default 0 not null;
+
+alter table orders
+    add column if not exists used_at timestamp;
+
+create index if not exists orders_key_ready_index
+    on orders (key, id)
+    where status = 2;
+
+-- Плейлисты заказа при завершении генерации
+create index if not exists playlist_turn_id_index
+    on playlist (turn_id);
@@ -0,0 +1,3 @@
+-- Жанр заказа генерации: входит в ключ кэша и передается модели
+alter table orders
+    add column if not exists genre varchar(32);
@@ -0,0 +1,2 @@
+-- tunes.active читает все активные треки по status, жанр выбирается в памяти: индекс по genre не используется
+drop index if exists tunes_genre_active_index;
@@ -0,0 +1,38 @@
+from sanic import response
+from sanic.views import HTTPMethodView
+
+from clients.outbox import outbox
+from clients.telegram import tgclient
+from core.cache import cache
+from core.catalogue import catalogue
+from core.customers import customers
+from core.db import db
+from core.generation import generation
+from core.httpclient import client
+from core.lemmatizer import lemmatizer
+from core.storage import storage
+from core.tunes import tunes
+from core.updates import updates
+from core.writer import writer
+from webhooks.poller import poller
+
+
+class StatsView(HTTPMethodView):
+    async def get(self, request):
+        return response.json({
+            '_success': True,
+            'http': client.stats(),
+            'outbox': await outbox.stats(),
+            'telegram': tgclient.stats(),
+            'lemmatizer': lemmatizer.stats(),
+            'catalogue': catalogue.stats(),
+            'customers': customers.stats(),
+            'tunes': tunes.stats(),
+            'db': db.stats(),
+            'writer': writer.stats(),
+            'redis': cache.stats(),
+            'uploads': storage.stats(),
+            'generation': await generation.stats(),
+            'updates': updates.stats(),
+            'poller': poller.stats(),
+        })
@@ -1,34 +1,92 @@
-import os
-import uuid
-
-import aiofiles
 from sanic import response
-from sanic.views import HTTPMethodView
+from sanic.views import HTTPMethodView, stream
 
+from core.multipart import MultipartReader, get_boundary
+from core.storage import FileTooLarge, storage
 from settings import settings
 
+MAX_SIZE = settings.get('upload', {}).get('max_size', 50 * 1024 * 1024)
+
 
 class UploadView(HTTPMethodView):
+    # Тело запроса читается потоком и сразу пишется на диск (storage.save),
+    # поэтому память на загрузку не зависит от размера файла.
+    # Принимает multipart/form-data с полем file или сам файл телом запроса (?name=track.mp3).
+    # Файлы хранятся по содержимому (core.storage): известный ?sha256= с пустым телом
+    # добавляет ссылку на уже загруженный файл без передачи данных
+
+    async def get(self, request):  # Есть ли файл с таким sha256
+        upload = await storage.find(request.args.get('sha256') or '')
+        if upload:
+            return response.json({
+                '_success': True,
+                'file_name': upload['path'],
+                'size': upload['size'],
+            })
+
+        return response.json({
+            '_success': False,
+            'message': 'File not found'
+        }, status=404)
+
+    @stream
     async def post(self, request):
-        file_path = settings.get('file_path', '') + '/static/uploads'
-        file = request.files and request.files['file']
-        if file:
-            file = file[0]
-            uid = str(uuid.uuid4())
+        upload = await storage.find(request.args.get('sha256') or '')
+        if upload:
+            upload = await storage.acquire(upload['path'])  # {} - файл удалили между find и acquire
+        if upload:
+            return response.json({
+                '_success': True,
+                'file_name': upload['path'],
+                'size': upload['size'],
+                'sha256': request.args.get('sha256'),
+            })
 
-            ext = file.name.split('.')[len(file.name.split('.')) - 1]  # [::-1][0]
-            file_name = f'{file_path}/{uid[:2]}/{uid[2:4]}/{uid}.{ext}'
-            os.makedirs(f'{file_path}/{uid[:2]}/{uid[2:4]}', 0o755, True)
+        boundary = get_boundary(request.headers.get('content-type'))
+        result = None
+        try:
+            if boundary:
+                reader = MultipartReader(request.stream, boundary)
+                while True:
+                    headers = await reader.next_part()
+                    if headers is None:
+                        break
 
-            async with aiofiles.open(file_name, 'wb') as f:
-                await f.write(file.body)
+                    disposition = reader.disposition(headers)
+                    if disposition.get('name') == 'file' and disposition.get('filename'):
+                        result = await storage.save(disposition['filename'], reader.read_part(), MAX_SIZE)
+                        break
+            else:
+                name = request.args.get('name') or request.headers.get('x-file-name')
+                result = await storage.save(name, self.read_body(request), MAX_SIZE) if name else None
 
+        except FileTooLarge:
+            return response.json({
+                '_success': False,
+                'message': f'File is larger than {MAX_SIZE} bytes'
+            }, status=413)
+
+        except ValueError as e:
+            return response.json({
+                '_success': False,
+                'message': str(e)
+            }, status=400)
+
+        if result:
             return response.json({
                 '_success': True,
-                'file_name': f'{uid[:2]}/{uid[2:4]}/{uid}.{ext}'
+                **result
             })
 
         return response.json({
             '_success': False,
             'message': 'File not found'
         }, status=405)
+
+    @classmethod
+    async def read_body(cls, request):
+        while True:
+            chunk = await request.stream.read()
+            if chunk is None:
+                return
+            yield chunk
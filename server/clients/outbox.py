@@ -0,0 +1,286 @@
+import asyncio
+import random
+from collections import deque
+
+import ujson
+
+from clients.telegram import tgclient
+from core.cache import cache
+from utils.ints import IntUtils
+
+__all__ = ['outbox']
+
+PUT_SCRIPT = '''
+local n = redis.call('RPUSH', KEYS[1], ARGV[1])
+if n == 1 then
+    redis.call('RPUSH', KEYS[2], ARGV[2])
+end
+return n
+'''
+
+# Взять чат из ready и поставить lease одной операцией: recover не увидит чат ни в очереди, ни под lease.
+# Если lease уже есть (чат попал в ready дважды), чат занят другим воркером - его done вернет чат в очередь
+TAKE_SCRIPT = '''
+local chat_id = redis.call('LPOP', KEYS[1])
+if not chat_id then
+    return false
+end
+if not redis.call('SET', KEYS[2] .. chat_id, '1', 'NX', 'EX', ARGV[1]) then
+    return {chat_id, ''}
+end
+local item = redis.call('LINDEX', KEYS[3] .. chat_id, 0)
+if not item then
+    redis.call('DEL', KEYS[2] .. chat_id)
+    return {chat_id, ''}
+end
+return {chat_id, item}
+'''
+
+RECOVER_SCRIPT = '''
+if redis.call('EXISTS', KEYS[2]) == 0 and redis.call('LLEN', KEYS[3]) > 0 then
+    redis.call('RPUSH', KEYS[1], ARGV[1])
+    return 1
+end
+return 0
+'''
+
+DONE_SCRIPT = '''
+redis.call('LPOP', KEYS[1])
+redis.call('DEL', KEYS[3])
+if redis.call('LLEN', KEYS[1]) > 0 then
+    redis.call('RPUSH', KEYS[2], ARGV[1])
+end
+return 1
+'''
+
+
+class MemoryBackend:
+    # Очередь в памяти процесса: для тестов и запуска без Redis
+
+    def __init__(self):
+        self.chats = {}
+        self.ready = asyncio.Queue()
+
+    async def put(self, chat_id, item):
+        items = self.chats.get(chat_id)
+        if items is None:
+            self.chats[chat_id] = deque([item])
+            self.ready.put_nowait(chat_id)
+        else:
+            items.append(item)
+
+    async def take(self, timeout=1):
+        try:
+            chat_id = await asyncio.wait_for(self.ready.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        return chat_id, self.chats[chat_id][0]
+
+    async def done(self, chat_id):
+        items = self.chats[chat_id]
+        items.popleft()
+        if items:
+            self.ready.put_nowait(chat_id)
+        else:
+            del self.chats[chat_id]
+
+    async def recover(self):
+        return 0
+
+    async def size(self) -> int:
+        return len(self.chats)
+
+
+class RedisBackend:
+    # Сообщение остается в голове списка чата, пока не доставлено: порядок внутри чата сохраняется,
+    # а при падении воркера сообщение не теряется (recover вернет чат в очередь после истечения lease)
+    PREFIX = 'art:telegram:outbox'
+    LEASE_TTL = 300
+
+    def __init__(self):
+        self.wakeup = asyncio.Event()
+
+    def chat_key(self, chat_id):
+        return f'{self.PREFIX}:chat:{chat_id}'
+
+    def lease_key(self, chat_id):
+        return f'{self.PREFIX}:lease:{chat_id}'
+
+    @property
+    def ready_key(self):
+        return f'{self.PREFIX}:ready'
+
+    async def put(self, chat_id, item):
+        await cache.eval(
+            PUT_SCRIPT,
+            keys=[self.chat_key(chat_id), self.ready_key],
+            args=[ujson.dumps(item), chat_id]
+        )
+        self.wakeup.set()
+
+    async def take(self, timeout=1):
+        result = await cache.eval(
+            TAKE_SCRIPT,
+            keys=[self.ready_key, f'{self.PREFIX}:lease:', f'{self.PREFIX}:chat:'],
+            args=[self.LEASE_TTL]
+        )
+        if not result:
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            return None
+
+        chat_id, item = result
+        if not item:
+            return None
+
+        return chat_id, ujson.loads(item)
+
+    async def done(self, chat_id):
+        await cache.eval(
+            DONE_SCRIPT,
+            keys=[self.chat_key(chat_id), self.ready_key, self.lease_key(chat_id)],
+            args=[chat_id]
+        )
+
+    async def recover(self) -> int:
+        if not await cache.set(f'{self.PREFIX}:recover', '1', expire=self.LEASE_TTL, exist='SET_IF_NOT_EXIST'):
+            return 0
+
+        ready = set(await cache.lrange(self.ready_key, 0, -1) or [])
+        recovered = 0
+        async for key in cache.iscan(match=f'{self.PREFIX}:chat:*'):
+            chat_id = key.split(':')[-1]
+            if chat_id in ready:
+                continue
+            recovered += await cache.eval(
+                RECOVER_SCRIPT,
+                keys=[self.ready_key, self.lease_key(chat_id), self.chat_key(chat_id)],
+                args=[chat_id]
+            )
+
+        return recovered
+
+    async def size(self) -> int:
+        return IntUtils.to_int(await cache.llen(self.ready_key), default=0)
+
+
+class TelegramOutbox:
+    BACKENDS = {
+        'memory': MemoryBackend,
+        'redis': RedisBackend,
+    }
+
+    MAX_ATTEMPTS = 5
+    BACKOFF_BASE = 0.5
+    BACKOFF_MAX = 30
+    RECOVER_INTERVAL = 60
+
+    def __init__(self):
+        self.backend = None
+        self.workers = []
+        self.recovery = None
+        self.closing = False
+
+        self.sent = 0
+        self.retried = 0
+        self.dropped = 0
+
+    async def initialize(self, backend='redis', workers=4):
+        self.backend = self.BACKENDS[backend]()
+        self.closing = False
+
+        await self.backend.recover()
+
+        self.workers = [asyncio.ensure_future(self.worker()) for _ in range(workers)]
+        self.recovery = asyncio.ensure_future(self.recoverer())
+
+    async def close(self, timeout=10):
+        self.closing = True
+        if self.recovery is not None:
+            self.recovery.cancel()
+            self.recovery = None
+        if self.workers:
+            _, pending = await asyncio.wait(self.workers, timeout=timeout)
+            for x in pending:
+                x.cancel()
+        self.workers = []
+
+    async def send(self, method_name: str = 'sendMessage', payload=None):
+        chat_id = str(payload['chat_id'])
+
+        if self.backend is None:
+            # Очередь не запущена (скрипты), отправляем синхронно
+            return await self.deliver({'method_name': method_name, 'payload': payload})
+
+        await self.backend.put(chat_id, {'method_name': method_name, 'payload': payload})
+
+    async def worker(self):
+        while True:
+            try:
+                task = await self.backend.take()
+            except Exception as e:
+                print(f'[outbox] {e}')
+                await asyncio.sleep(1)
+                continue
+
+            if task is None:
+                if self.closing:
+                    return
+                continue
+
+            chat_id, item = task
+            try:
+                await self.deliver(item)
+            except Exception as e:
+                print(f'[outbox] {e}')
+
+            try:
+                await self.backend.done(chat_id)
+            except Exception as e:
+                print(f'[outbox] {e}')
+
+    async def recoverer(self):
+        while True:
+            await asyncio.sleep(self.RECOVER_INTERVAL)
+            try:
+                await self.backend.recover()
+            except Exception as e:
+                print(f'[outbox] {e}')
+
+    async def deliver(self, item) -> dict:
+        result = {}
+        for attempt in range(self.MAX_ATTEMPTS):
+            result = await tgclient.api_call(method_name=item['method_name'], payload=item['payload'])
+            if result.get('ok'):
+                self.sent += 1
+                return result
+
+            error_code = IntUtils.to_int(result.get('error_code'))
+            if error_code == 429:
+                break  # api_call уже повторял с retry_after через лимитер, второй слой повторов не нужен
+            if result and (not error_code or error_code < 500):
+                break  # Ошибка запроса (400, 403 ...), повтор не поможет
+
+            delay = min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1)
+
+            self.retried += 1
+            await asyncio.sleep(delay)
+
+        self.dropped += 1
+        print(f'[outbox] dropped {item["method_name"]}: {result}')
+        return result
+
+    async def stats(self) -> dict:
+        return {
+            'pending_chats': await self.backend.size() if self.backend else 0,
+            'workers': len(self.workers),
+            'sent': self.sent,
+            'retried': self.retried,
+            'dropped': self.dropped,
+        }
+
+
+outbox = TelegramOutbox()
@@ -1,31 +1,331 @@
+import asyncio
+import os
+import time
+from collections import deque
+
+import aiohttp
+
 from core import httpclient
+from core.cache import cache
 from settings import settings
+from utils.ints import IntUtils
+
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now) -> float:  # Сколько секунд ждать до следующего токена
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+
+class RateLimiter:
+    # Глобальный бюджет бота и бюджет на каждый чат. Ожидающие чаты обслуживаются по кругу,
+    # поэтому рассылка в один чат не задерживает остальных
+    MAX_BUCKETS = 10000
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+
+        self.bucket = TokenBucket(global_rate, global_rate)
+        self.buckets = {}
+        self.blocked_until = 0
+        self.chat_blocked_until = {}
+
+        self.waiters = {}
+        self.rotation = deque()
+        self.wakeup = None
+        self.dispatcher = None
+
+        self.granted = 0
+        self.throttled = 0
+        self.retry_after_hits = 0
+
+    def chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def chat_delay(self, chat_id, now) -> float:
+        return max(
+            self.chat_bucket(chat_id).delay(now),
+            self.chat_blocked_until.get(chat_id, 0) - now
+        )
+
+    def global_delay(self, now) -> float:
+        return max(self.bucket.delay(now), self.blocked_until - now)
+
+    def grant(self, chat_id):
+        self.bucket.consume()
+        self.chat_bucket(chat_id).consume()
+        self.granted += 1
+
+    async def acquire(self, chat_id):
+        now = time.monotonic()
+        if len(self.buckets) > self.MAX_BUCKETS:
+            self.prune(now)
+
+        if not self.rotation and self.global_delay(now) <= 0 and self.chat_delay(chat_id, now) <= 0:
+            self.grant(chat_id)
+            return
+
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.ensure_future(self.dispatch())
+
+        future = asyncio.get_event_loop().create_future()
+        waiters = self.waiters.get(chat_id)
+        if waiters is None:
+            waiters = self.waiters[chat_id] = deque()
+            self.rotation.append(chat_id)
+        waiters.append(future)
+
+        self.throttled += 1
+        self.wakeup.set()
+
+        await future
+
+    def penalize(self, chat_id, retry_after):
+        self.retry_after_hits += 1
+        until = time.monotonic() + retry_after
+        if chat_id is None:
+            self.blocked_until = max(self.blocked_until, until)
+        else:
+            self.chat_blocked_until[chat_id] = max(self.chat_blocked_until.get(chat_id, 0), until)
+
+    def prune(self, now):
+        for chat_id, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity and chat_id not in self.waiters:
+                del self.buckets[chat_id]
+
+        for chat_id, until in list(self.chat_blocked_until.items()):
+            if until <= now:
+                del self.chat_blocked_until[chat_id]
+
+    async def sleep(self, timeout):
+        self.wakeup.clear()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def dispatch(self):
+        while True:
+            if not self.rotation:
+                self.prune(time.monotonic())
+                await self.sleep(None)
+                continue
+
+            now = time.monotonic()
+            delay = self.global_delay(now)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            delay = None
+            for _ in range(len(self.rotation)):
+                chat_id = self.rotation[0]
+                self.rotation.rotate(-1)
+
+                chat_delay = self.chat_delay(chat_id, now)
+                if chat_delay > 0:
+                    delay = chat_delay if delay is None else min(delay, chat_delay)
+                    continue
+
+                waiters = self.waiters[chat_id]
+                while waiters:
+                    future = waiters.popleft()
+                    if not future.done():
+                        self.grant(chat_id)
+                        future.set_result(None)
+                        break
+
+                if not waiters:
+                    del self.waiters[chat_id]
+                    self.rotation.pop()
+
+                delay = 0
+                break
+
+            if delay:
+                await self.sleep(delay)
+
+    def stats(self) -> dict:
+        return {
+            'queued': sum(len(x) for x in self.waiters.values()),
+            'queued_chats': len(self.rotation),
+            'granted': self.granted,
+            'throttled': self.throttled,
+            'retry_after_hits': self.retry_after_hits,
+            'global_rate': self.global_rate,
+            'chat_rate': self.chat_rate,
+        }
+
+
+# GCRA: в Redis хранится теоретическое время следующей отправки в чат (tat, мс).
+# Отправка разрешена, если tat не ушло вперед больше чем на burst интервалов; иначе - сколько ждать
+CHAT_BUDGET_SCRIPT = '''
+local now = tonumber(ARGV[1])
+local interval = tonumber(ARGV[2])
+local tolerance = tonumber(ARGV[3])
+local tat = tonumber(redis.call('GET', KEYS[1]) or now)
+if tat < now then
+    tat = now
+end
+local delay = tat + interval - tolerance - now
+if delay > 0 then
+    return delay
+end
+redis.call('SET', KEYS[1], tat + interval, 'PX', math.ceil(tat + interval - now) + 1000)
+return 0
+'''
+
+# 429 с retry_after: tat сдвигается так, чтобы следующая отправка была разрешена не раньше until
+# (delay = tat + interval - tolerance - now), и никогда не уменьшается
+CHAT_PENALTY_SCRIPT = '''
+local now = tonumber(ARGV[1])
+local tat = tonumber(ARGV[2]) + tonumber(ARGV[4]) - tonumber(ARGV[3])
+local current = tonumber(redis.call('GET', KEYS[1]) or 0)
+if current > tat then
+    tat = current
+end
+redis.call('SET', KEYS[1], tat, 'PX', math.ceil(tat - now) + 1000)
+return tat
+'''
+
+
+class SharedChatBudget:
+    # Бюджет чата, общий для всех воркеров: сообщения одного чата из Redis-очереди outbox
+    # отправляют разные процессы, и локальные бакеты RateLimiter дали бы чату N x chat_rate
+    PREFIX = 'art:telegram:budget'
+
+    def __init__(self, chat_rate=1, chat_burst=3):
+        self.interval = 1000 / chat_rate
+        self.tolerance = self.interval * chat_burst
+
+        self.waits = 0
+
+    def key(self, chat_id):
+        return f'{self.PREFIX}:{chat_id}'
+
+    async def acquire(self, chat_id):
+        while True:
+            delay = await cache.eval(
+                CHAT_BUDGET_SCRIPT,
+                keys=[self.key(chat_id)],
+                args=[int(time.time() * 1000), self.interval, self.tolerance]
+            )
+            delay = float(delay or 0)
+            if delay <= 0:
+                return
+
+            self.waits += 1
+            await asyncio.sleep(delay / 1000)
+
+    async def penalize(self, chat_id, retry_after):  # 429 с retry_after: остальные воркеры тоже ждут
+        now = int(time.time() * 1000)
+        await cache.eval(
+            CHAT_PENALTY_SCRIPT,
+            keys=[self.key(chat_id)],
+            args=[now, now + retry_after * 1000, self.interval, self.tolerance]
+        )
 
 
 class TelegramClient:
     TOKEN = settings.get('tg', {}).get('token')
+    API_URL = settings.get('tg', {}).get('api_url', 'https://api.telegram.org')  # для нагрузочных тестов - заглушка Bot API
+    MAX_RETRIES = 3
+
+    def __init__(self):
+        # Лимит бота общий, а лимитер у каждого воркера свой: делим глобальный бюджет между воркерами
+        workers = settings.get('server', {}).get('workers', 1) or os.cpu_count()
+        self.limiter = RateLimiter(
+            global_rate=settings.get('tg', {}).get('global_rate', 30) / max(workers, 1),
+            chat_rate=settings.get('tg', {}).get('chat_rate', 1),
+            chat_burst=settings.get('tg', {}).get('chat_burst', 3),
+        )
+        # При нескольких воркерах бюджет чата ведется в Redis, локальный бакет чата его не превысит
+        self.budget = SharedChatBudget(
+            chat_rate=settings.get('tg', {}).get('chat_rate', 1),
+            chat_burst=settings.get('tg', {}).get('chat_burst', 3),
+        ) if workers > 1 else None
 
     async def api_call(
         self,
         http_method: str = 'post',
         method_name: str = 'sendMessage',
-        payload=None
+        payload=None,
+        timeout=None
     ) -> dict:
 
         if http_method.strip().lower() == 'post':
             if not method_name:
                 return {}
 
-            success, result = await httpclient.request(
-                method='post',
-                url=f'https://api.telegram.org/bot{self.TOKEN}/{method_name}',
-                json=payload,
-            )
+            chat_id = (payload or {}).get('chat_id')
+            if chat_id is not None:
+                chat_id = str(chat_id)
+
+            result = None
+            for attempt in range(self.MAX_RETRIES + 1):
+                if chat_id is not None:
+                    if self.budget is not None and cache.pool is not None:
+                        await self.budget.acquire(chat_id)
+                    await self.limiter.acquire(chat_id)
+
+                options = {}
+                if timeout is not None:  # long polling держит запрос дольше общего таймаута клиента
+                    options['timeout'] = aiohttp.ClientTimeout(connect=5, total=timeout)
+
+                success, result = await httpclient.request(
+                    method='post',
+                    url=f'{self.API_URL}/bot{self.TOKEN}/{method_name}',
+                    json=payload,
+                    **options
+                )
+
+                if not success or not result:
+                    return {}
+
+                if result.get('error_code') != 429 or attempt == self.MAX_RETRIES:
+                    break
+
+                retry_after = IntUtils.to_int((result.get('parameters') or {}).get('retry_after'), default=1)
+                self.limiter.penalize(chat_id, retry_after)
+                if chat_id is not None and self.budget is not None and cache.pool is not None:
+                    await self.budget.penalize(chat_id, retry_after)
+                if chat_id is None:
+                    await asyncio.sleep(retry_after)
+
+            return result
 
-            if success and result:
-                return result
+        return {}
 
-            return {}
+    def stats(self) -> dict:
+        return {
+            **self.limiter.stats(),
+            'shared_chat_budget': self.budget is not None,
+            'shared_chat_waits': self.budget.waits if self.budget is not None else 0,
+        }
 
 
 tgclient = TelegramClient()
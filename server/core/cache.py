@@ -1,4 +1,6 @@
+import asyncio
 import functools
+from inspect import isawaitable
 from typing import Union
 
 import aio_pika
@@ -16,13 +18,17 @@ class Cache:
 
         self.channel = None
 
-    async def initialize(self, loop, db=1, maxsize=10):
+        self.subscriber = None
+        self.listeners = {}
+
+    async def initialize(self, loop, db=1, minsize=1, maxsize=10, extra_maxsize=2):
         self.loop = loop
 
         self.pool = await aioredis.create_redis_pool(
             settings['redis'],
             db=db,
             loop=loop,
+            minsize=minsize,
             maxsize=maxsize,
             encoding='utf-8'
         )
@@ -31,11 +37,11 @@ class Cache:
             settings['redis'],
             db=3,
             loop=loop,
-            maxsize=2,
+            maxsize=extra_maxsize,
             encoding='utf-8'
         )
 
-        # self.subscriber = await aioredis.create_redis_pool(settings['redis'], loop=loop)
+        self.subscriber = await aioredis.create_redis(settings['redis'], loop=loop, encoding='utf-8')
 
         # connection = await aio_pika.connect_robust(
         #     settings['mq'], loop=loop
@@ -43,11 +49,48 @@ class Cache:
         #
         # self.channel = await connection.channel()  # type: aio_pika.Channel
 
+    async def close(self):
+        for x in [self.subscriber, self.pool, self.extra_pool]:
+            if x is not None:
+                x.close()
+                await x.wait_closed()
+
+    async def subscribe(self, channel, callback):
+        listeners = self.listeners.get(channel)
+        if listeners is None:
+            listeners = self.listeners[channel] = []
+            ch, = await self.subscriber.subscribe(channel)
+            asyncio.ensure_future(self._listen(channel, ch))
+        listeners.append(callback)
+
+    async def _listen(self, channel, ch):
+        while await ch.wait_message():
+            message = await ch.get(encoding='utf-8')
+            for callback in self.listeners.get(channel, []):
+                try:
+                    result = callback(message)
+                    if isawaitable(result):
+                        await result
+                except Exception as e:
+                    print(f'[cache] {channel}: {e}')
+
     def __getattr__(self, attr):
         return functools.partial(getattr(self.pool, attr))
 
     def multi_exec(self):
         return self.pool.multi_exec()
 
+    def stats(self) -> dict:
+        result = {}
+        for name, x in [('pool', self.pool), ('extra_pool', self.extra_pool)]:
+            if x is not None:
+                result[name] = {
+                    'size': x.connection.size,
+                    'free': x.connection.freesize,
+                    'min_size': x.connection.minsize,
+                    'max_size': x.connection.maxsize,
+                }
+        return result
+
 
 cache = Cache()  # type: Union[aioredis.Redis, Cache]
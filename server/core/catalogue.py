@@ -0,0 +1,121 @@
+import asyncio
+import random
+import time
+
+from core.cache import cache
+from core.db import db
+
+__all__ = ['catalogue']
+
+LOAD_QUESTIONS = db.query(
+    'catalogue.load',
+    '''
+    SELECT q.*, c.attempt AS category_attempt
+    FROM public.questions q
+    JOIN public.categories c on c.id = q.category_id
+    WHERE c.type = $1
+    ORDER BY c.id, q.position
+    '''
+)
+
+
+class QuestionCatalogue:
+    # Категории и вопросы в памяти процесса по type. Версия меняется при каждой загрузке;
+    # сбрасывается по TTL и по сообщению в канал CHANNEL (type или '*')
+    CHANNEL = 'art:catalogue:invalidate'
+
+    def __init__(self):
+        self.ttl = 300
+        self.types = {}
+        self.questions = {}
+        self.locks = {}
+        self.version = 0
+
+        self.hits = 0
+        self.loads = 0
+
+    async def initialize(self, ttl=300):
+        self.ttl = ttl
+        await cache.subscribe(self.CHANNEL, self.reset)
+
+    def reset(self, _type='*'):
+        if not _type or _type == '*':
+            self.types = {}
+        else:
+            self.types.pop(_type, None)
+
+    async def invalidate(self, _type='*'):  # Сбросить кэш во всех воркерах
+        self.reset(_type)
+        await cache.publish(self.CHANNEL, _type)
+
+    async def get(self, _type) -> dict:
+        entry = self.types.get(_type)
+        if entry and entry['expires_at'] > time.monotonic():
+            self.hits += 1
+            return entry
+
+        lock = self.locks.get(_type)
+        if lock is None:
+            lock = self.locks[_type] = asyncio.Lock()
+
+        async with lock:
+            entry = self.types.get(_type)
+            if entry and entry['expires_at'] > time.monotonic():
+                self.hits += 1
+                return entry
+            return await self.load(_type)
+
+    async def load(self, _type) -> dict:
+        items = await db.fetch(LOAD_QUESTIONS, _type)
+
+        categories, questions = {}, {}
+        for item in items:
+            question = dict(item)
+            attempt = question.pop('category_attempt')
+            category = categories.get(question['category_id'])
+            if category is None:
+                category = categories[question['category_id']] = {'attempt': attempt, 'question_ids': []}
+            category['question_ids'].append(question['id'])
+            questions[question['id']] = question
+
+        self.version += 1
+        self.loads += 1
+        self.questions.update(questions)
+
+        entry = self.types[_type] = {
+            'version': self.version,
+            'expires_at': time.monotonic() + self.ttl,
+            'categories': list(categories.values()),
+            'questions': questions,
+        }
+        return entry
+
+    async def question(self, _type, question_id) -> dict:
+        entry = await self.get(_type)
+        return entry['questions'].get(question_id) or self.questions.get(question_id)
+
+    async def sample(self, _type) -> list:  # Случайный набор вопросов: attempt вопросов из каждой категории
+        entry = await self.get(_type)
+
+        question_ids = []
+        for category in entry['categories']:
+            attempt = category['attempt']
+            if attempt is not None and len(category['question_ids']) > attempt:
+                question_ids.extend(random.sample(category['question_ids'], attempt))
+            else:
+                question_ids.extend(category['question_ids'])
+
+        questions = [entry['questions'][x] for x in question_ids]
+        questions.sort(key=lambda x: (x['position'], random.random()))
+
+        return [dict(x) for x in questions]
+
+    def stats(self) -> dict:
+        return {
+            'types': {k: {'version': v['version'], 'questions': len(v['questions'])} for k, v in self.types.items()},
+            'hits': self.hits,
+            'loads': self.loads,
+        }
+
+
+catalogue = QuestionCatalogue()
@@ -0,0 +1,76 @@
+import ujson
+
+from core.cache import cache
+
+__all__ = ['Conversation']
+
+
+class Conversation:
+    # Состояние диалога клиента хранится одним hash: читается одним HGETALL,
+    # изменения пишутся одним MULTI с общим TTL
+    PREFIX = 'art:telegram:state'
+    TTL = 600
+
+    KEEP_FIELDS = ('audio',)  # переживают finalize: id трека, ожидающего названия
+
+    def __init__(self, customer_id, data=None):
+        self.customer_id = customer_id
+        self.data = data or {}
+
+        self.changed = {}
+        self.deleted = set()
+
+    @property
+    def key(self):
+        return f'{self.PREFIX}:{self.customer_id}'
+
+    @classmethod
+    async def load(cls, customer_id) -> 'Conversation':
+        data = await cache.hgetall(f'{cls.PREFIX}:{customer_id}') or {}
+        return cls(customer_id, {k: ujson.loads(v) for k, v in data.items()})
+
+    @property
+    def current(self):  # Текущее состояние диалога
+        return self.data.get('state')
+
+    def transition(self, value):
+        if value is None:
+            self.delete('state')
+        else:
+            self.set('state', value)
+
+    def get(self, field, default=None):
+        return self.data.get(field, default)
+
+    def set(self, field, value):
+        self.data[field] = value
+        self.changed[field] = value
+        self.deleted.discard(field)
+
+    def delete(self, *fields):
+        for field in fields:
+            self.data.pop(field, None)
+            self.changed.pop(field, None)
+            self.deleted.add(field)
+
+    def clear(self):  # Завершить диалог
+        self.delete(*[x for x in self.data if x not in self.KEEP_FIELDS])
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self.changed or self.deleted)
+
+    async def save(self):
+        if not self.dirty:
+            return
+
+        tr = cache.multi_exec()
+        if self.deleted:
+            tr.hdel(self.key, *self.deleted)
+        if self.changed:
+            tr.hmset_dict(self.key, {k: ujson.dumps(v) for k, v in self.changed.items()})
+        tr.expire(self.key, self.TTL)
+        await tr.execute()
+
+        self.changed = {}
+        self.deleted = set()
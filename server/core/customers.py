@@ -0,0 +1,69 @@
+import ujson
+
+from core.cache import cache
+from core.db import db
+from core.lru import LRUCache
+
+__all__ = ['customers']
+
+UPSERT_CUSTOMER = db.query(
+    'customers.upsert',
+    '''
+    INSERT INTO public.customers(name, username, uid)
+    VALUES ($1, $2, $3)
+    ON CONFLICT (uid) DO UPDATE SET uid = EXCLUDED.uid
+    RETURNING id, username
+    '''
+)
+
+
+class CustomerCache:
+    # chat_id -> клиент: LRU в памяти процесса, затем Redis, затем один upsert в БД
+    PREFIX = 'art:customer'
+    TTL = 60 * 60 * 24
+
+    def __init__(self):
+        self.customers = LRUCache(maxsize=10000)
+
+        self.shared_hits = 0
+        self.queries = 0
+
+    async def initialize(self, maxsize=10000):
+        self.customers = LRUCache(maxsize=maxsize)
+
+    async def get(self, uid, sender=None) -> dict:
+        customer = self.customers.get(uid)
+        if customer:
+            return customer
+
+        customer = await cache.get(f'{self.PREFIX}:{uid}')
+        if customer:
+            self.shared_hits += 1
+            customer = ujson.loads(customer)
+        else:
+            sender = sender or {}
+            self.queries += 1
+            customer = dict(await db.fetchrow(
+                UPSERT_CUSTOMER,
+                sender.get('first_name'),
+                sender.get('username'),
+                uid
+            ))
+            await cache.setex(f'{self.PREFIX}:{uid}', self.TTL, ujson.dumps(customer))
+
+        self.customers.set(uid, customer)
+        return customer
+
+    async def forget(self, uid):
+        self.customers.delete(uid)
+        await cache.delete(f'{self.PREFIX}:{uid}')
+
+    def stats(self) -> dict:
+        return {
+            'cache': self.customers.stats(),
+            'shared_hits': self.shared_hits,
+            'queries': self.queries,
+        }
+
+
+customers = CustomerCache()
@@ -1,4 +1,8 @@
+import asyncio
+import contextlib
 import logging
+import time
+from contextvars import ContextVar
 
 import asyncpg
 import ujson
@@ -6,7 +10,7 @@ from motor import motor_asyncio
 
 from settings import settings
 
-__all__ = ['mongo']
+__all__ = ['mongo', 'db', 'Query']
 
 logger = logging.getLogger(__name__)
 
@@ -29,8 +33,122 @@ class MongoProxy:
         return self.db[item]
 
 
+class Query:
+    # Именованный запрос: объявляется один раз, готовится на каждом соединении пула
+    # и вызывается через db.fetch(QUERY, ...) или db.fetch('name', ...)
+
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0
+        self.max_time = 0
+
+    def observe(self, elapsed):
+        self.calls += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+    def stats(self) -> dict:
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'total_ms': round(self.total_time * 1000, 2),
+            'avg_ms': round(self.total_time * 1000 / self.calls, 2) if self.calls else 0,
+            'max_ms': round(self.max_time * 1000, 2),
+        }
+
+    def __repr__(self):
+        return f'<Query {self.name}>'
+
+
+class ConnectionScope:
+    # Соединение одной единицы работы (например, одного update вебхука): берется из пула
+    # при первом запросе и отдается при выходе из db.connection(). Принадлежит задаче,
+    # открывшей scope: дочерние задачи (gather) берут свои соединения из пула
+
+    def __init__(self, proxy, transaction=False):
+        self.proxy = proxy
+        self.transaction = transaction
+        self.task = asyncio.current_task()
+
+        self.conn = None
+        self.tx = None
+        self.queries = 0
+
+    @property
+    def active(self) -> bool:
+        return self.task is asyncio.current_task()
+
+    async def get(self):
+        if self.conn is None:
+            self.conn = await self.proxy.acquire_connection()
+            if self.transaction:
+                self.tx = self.conn.transaction()
+                await self.tx.start()
+        self.queries += 1
+        return self.conn
+
+    async def close(self, failed=False):
+        if self.conn is None:
+            return
+
+        try:
+            if self.tx is not None:
+                if failed:
+                    await self.tx.rollback()
+                else:
+                    await self.tx.commit()
+        finally:
+            await self.proxy.release_connection(self.conn)
+            self.conn = None
+            self.tx = None
+
+
+_scope = ContextVar('db_scope', default=None)
+
+
 class DBProxy:
     pool = None
+    queries = {}  # name -> Query
+
+    # Адаптивный режим: пул создается с max_size, а число одновременно выданных соединений
+    # ограничивается мягким лимитом между min_size и max_size. Раз в TUNE_INTERVAL секунд лимит
+    # растет, если среднее ожидание соединения больше GROW_WAIT, и уменьшается, если ожиданий нет
+    # и лимит не используется. Лишние простаивающие соединения пул закрывает сам
+    TUNE_INTERVAL = 10
+    GROW_WAIT = 0.05
+    SHRINK_WAIT = 0.005
+
+    def __init__(self):
+        self.statements = {}  # pid соединения -> {name: PreparedStatement}
+
+        self.min_size = 2
+        self.max_size = 15
+        self.adaptive = False
+        self.limit = 15
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.slots = None
+        self.tuner = None
+        self.window = (0, 0)  # (acquisitions, wait_time) на начало окна
+        self.last_window_wait = 0
+
+        self.acquisitions = 0
+        self.wait_time = 0
+        self.max_wait_time = 0
+        self.scopes = 0
+        self.reused = 0
+
+    def query(self, name, sql) -> Query:
+        query = self.queries.get(name)
+        if query is not None and query.sql != sql:
+            raise ValueError(f'query {name} is already registered')
+        if query is None:
+            query = self.queries[name] = Query(name, sql)
+        return query
 
     async def pool_connection_init(self, conn):
         await conn.set_type_codec(
@@ -47,7 +165,23 @@ class DBProxy:
             schema='pg_catalog'
         )
 
-    async def initialize(self, app, loop, min_size=2, max_size=15):
+        pid = conn.get_server_pid()
+        self.statements[pid] = {}
+        conn.add_termination_listener(lambda *_: self.statements.pop(pid, None))
+
+        for query in list(self.queries.values()):
+            try:
+                self.statements[pid][query.name] = await conn.prepare(query.sql)
+            except asyncpg.PostgresError as e:
+                print(f'[db] prepare {query.name}: {e}')
+
+    async def initialize(self, app, loop, min_size=2, max_size=15, adaptive=False):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.adaptive = adaptive
+        self.limit = max(min_size, max_size // 2) if adaptive else max_size
+        self.slots = asyncio.Condition()
+
         self.pool = await asyncpg.create_pool(
             database=app.config.DB_DATABASE,
             host=app.config.DB_HOST,
@@ -58,24 +192,216 @@ class DBProxy:
             min_size=min_size,
             max_size=max_size,
             command_timeout=300,
+            max_inactive_connection_lifetime=60 if adaptive else 300,
             loop=loop
         )
 
-    async def execute(self, *args, **kwargs):
-        async with self.pool.acquire() as db:
-            return await db.execute(*args, **kwargs)
+        if adaptive:
+            self.tuner = asyncio.ensure_future(self.tune())
+
+    async def close(self):
+        if self.tuner is not None:
+            self.tuner.cancel()
+            self.tuner = None
+
+        if self.pool is not None:
+            await self.pool.close()
+
+    async def acquire_connection(self):
+        started = time.monotonic()
+        if self.adaptive:
+            async with self.slots:
+                await self.slots.wait_for(lambda: self.in_use < self.limit)
+                self.in_use += 1
+        else:
+            self.in_use += 1
+
+        try:
+            conn = await self.pool.acquire()
+        except BaseException:
+            await self.release_slot()
+            raise
+
+        elapsed = time.monotonic() - started
+        self.acquisitions += 1
+        self.wait_time += elapsed
+        self.max_wait_time = max(self.max_wait_time, elapsed)
+        self.peak_in_use = max(self.peak_in_use, self.in_use)
+        return conn
+
+    async def release_connection(self, conn):
+        try:
+            await self.pool.release(conn)
+        finally:
+            await self.release_slot()
+
+    async def release_slot(self):
+        self.in_use -= 1
+        if self.adaptive:
+            async with self.slots:
+                self.slots.notify()
+
+    async def tune(self):
+        while True:
+            await asyncio.sleep(self.TUNE_INTERVAL)
+
+            acquisitions, wait_time = self.window
+            count = self.acquisitions - acquisitions
+            wait = (self.wait_time - wait_time) / count if count else 0
+            peak, self.peak_in_use = self.peak_in_use, self.in_use
+            self.window = (self.acquisitions, self.wait_time)
+            self.last_window_wait = wait
+
+            step = max(1, self.max_size // 10)
+            if wait > self.GROW_WAIT and self.limit < self.max_size:
+                self.limit = min(self.max_size, self.limit + step)
+                print(f'[db] pool limit -> {self.limit}, avg wait {wait * 1000:.1f}ms')
+                async with self.slots:
+                    self.slots.notify_all()
+            elif wait < self.SHRINK_WAIT and peak < self.limit - step and self.limit > self.min_size:
+                self.limit = max(self.min_size, self.limit - 1)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):  # Соединение текущего scope или отдельное соединение из пула
+        scope = _scope.get()
+        if scope is not None and scope.active:
+            self.reused += 1
+            yield await scope.get()
+            return
+
+        conn = await self.acquire_connection()
+        try:
+            yield conn
+        finally:
+            await self.release_connection(conn)
+
+    @contextlib.asynccontextmanager
+    async def connection(self, transaction=False):
+        # Все запросы внутри блока идут через одно соединение, с transaction=True - в одной транзакции.
+        # Вложенный блок использует внешний scope; транзакция внутри scope без транзакции - на его соединении
+        scope = _scope.get()
+        if scope is not None and scope.active:
+            if not transaction or scope.tx is not None:
+                yield scope
+                return
+
+            conn = await scope.get()
+            async with conn.transaction():
+                yield scope
+            return
+
+        scope = ConnectionScope(self, transaction=transaction)
+        token = _scope.set(scope)
+        self.scopes += 1
+        try:
+            yield scope
+        except BaseException:
+            await scope.close(failed=True)
+            raise
+        else:
+            await scope.close()
+        finally:
+            _scope.reset(token)
+
+    def resolve(self, query):
+        if isinstance(query, Query):
+            return query
+        if isinstance(query, str):
+            return self.queries.get(query)
+        return None
+
+    async def statement(self, conn, query, refresh=False):
+        statements = self.statements.setdefault(conn.get_server_pid(), {})
+        statement = None if refresh else statements.get(query.name)
+        if statement is None:
+            statement = statements[query.name] = await conn.prepare(query.sql)
+        return statement
+
+    async def run(self, method, query, args, timeout=None):
+        async with self.acquire() as conn:
+            started = time.monotonic()
+            try:
+                try:
+                    statement = await self.statement(conn, query)
+                    result = await getattr(statement, method)(*args, timeout=timeout)
+                except (asyncpg.exceptions.InvalidCachedStatementError, asyncpg.exceptions.OutdatedSchemaCacheError):
+                    # Схема изменилась после подготовки: готовим запрос заново
+                    statement = await self.statement(conn, query, refresh=True)
+                    result = await getattr(statement, method)(*args, timeout=timeout)
+            except Exception:
+                query.errors += 1
+                raise
+            finally:
+                query.observe(time.monotonic() - started)
+
+            return statement, result
+
+    async def execute(self, query, *args, **kwargs):
+        _query = self.resolve(query)
+        if _query is None:
+            async with self.acquire() as db:
+                return await db.execute(query, *args, **kwargs)
+
+        statement, _ = await self.run('fetch', _query, args, **kwargs)
+        return statement.get_statusmsg()
+
+    async def executemany(self, query, args, **kwargs):  # Один запрос на пачку строк args
+        _query = self.resolve(query)
+        if _query is None:
+            async with self.acquire() as db:
+                return await db.executemany(query, args, **kwargs)
+
+        await self.run('executemany', _query, (args,), **kwargs)
+
+    async def fetch(self, query, *args, **kwargs):
+        _query = self.resolve(query)
+        if _query is None:
+            async with self.acquire() as db:
+                return await db.fetch(query, *args, **kwargs)
+
+        _, result = await self.run('fetch', _query, args, **kwargs)
+        return result
+
+    async def fetchrow(self, query, *args, **kwargs):
+        _query = self.resolve(query)
+        if _query is None:
+            async with self.acquire() as db:
+                return await db.fetchrow(query, *args, **kwargs)
+
+        _, result = await self.run('fetchrow', _query, args, **kwargs)
+        return result
 
-    async def fetch(self, *args, **kwargs):
-        async with self.pool.acquire() as db:
-            return await db.fetch(*args, **kwargs)
+    async def fetchval(self, query, *args, **kwargs):
+        _query = self.resolve(query)
+        if _query is None:
+            async with self.acquire() as db:
+                return await db.fetchval(query, *args, **kwargs)
 
-    async def fetchrow(self, *args, **kwargs):
-        async with self.pool.acquire() as db:
-            return await db.fetchrow(*args, **kwargs)
+        _, result = await self.run('fetchval', _query, args, **kwargs)
+        return result
 
-    async def fetchval(self, *args, **kwargs):
-        async with self.pool.acquire() as db:
-            return await db.fetchval(*args, **kwargs)
+    def stats(self) -> dict:
+        queries = sorted(self.queries.values(), key=lambda x: x.total_time, reverse=True)
+        return {
+            'pool': {
+                'size': self.pool.get_size() if self.pool else 0,
+                'idle': self.pool.get_idle_size() if self.pool else 0,
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'adaptive': self.adaptive,
+                'limit': self.limit,
+                'in_use': self.in_use,
+                'window_avg_wait_ms': round(self.last_window_wait * 1000, 2),
+                'acquisitions': self.acquisitions,
+                'wait_ms': round(self.wait_time * 1000, 2),
+                'avg_wait_ms': round(self.wait_time * 1000 / self.acquisitions, 2) if self.acquisitions else 0,
+                'max_wait_ms': round(self.max_wait_time * 1000, 2),
+                'scopes': self.scopes,
+                'reused': self.reused,
+            },
+            'prepared_connections': len(self.statements),
+            'queries': {x.name: x.stats() for x in queries},
+        }
 
 
 MONGO_HOST = settings.get('mongo', {}).get('db_host')
@@ -0,0 +1,597 @@
+import asyncio
+import random
+from inspect import isawaitable
+
+import replicate
+import ujson
+
+from core.cache import cache
+from core.db import db
+from core.hasher import text_to_hash
+from core.httpclient import client
+from core.storage import storage
+from core.tunes import tunes
+from core.writer import writer
+from settings import settings
+from utils.ints import IntUtils
+
+__all__ = ['generation', 'PENDING', 'PROCESSING', 'READY', 'SAVED', 'FAILED']
+
+# orders.status и playlist.status
+PENDING = 0
+PROCESSING = 1
+READY = 2
+SAVED = 3  # только playlist: клиент дал треку название
+FAILED = 4
+
+TAKE_SCRIPT = '''
+local id = redis.call('LPOP', KEYS[1])
+if not id then
+    return false
+end
+if redis.call('SET', KEYS[3] .. id, ARGV[1], 'NX', 'EX', ARGV[2]) then
+    redis.call('SADD', KEYS[2], id)
+    return id
+end
+return ''
+'''
+
+RELEASE_SCRIPT = '''
+redis.call('SREM', KEYS[2], ARGV[1])
+redis.call('DEL', KEYS[3])
+if ARGV[2] == '1' then
+    redis.call('RPUSH', KEYS[1], ARGV[1])
+end
+return 1
+'''
+
+RECOVER_SCRIPT = '''
+if redis.call('EXISTS', KEYS[3]) == 0 and redis.call('SREM', KEYS[2], ARGV[1]) == 1 then
+    redis.call('RPUSH', KEYS[1], ARGV[1])
+    return 1
+end
+return 0
+'''
+
+INSERT_ORDER = db.query(
+    'orders.insert',
+    '''
+    INSERT INTO public.orders(chat_id, words, key, genre, status)
+    VALUES ($1, $2, $3, $4, 0)
+    RETURNING id
+    '''
+)
+CACHED_ORDER = db.query(
+    'orders.cached',
+    '''
+    SELECT id, url
+    FROM public.orders
+    WHERE key = $1 AND status = 2
+    ORDER BY id DESC
+    LIMIT 1
+    '''
+)
+TOUCH_ORDER = db.query(
+    'orders.touch',
+    '''
+    UPDATE public.orders
+    SET hits = hits + 1, used_at = now()
+    WHERE id = $1
+    '''
+)
+EVICT_ORDERS = db.query(
+    'orders.evict',
+    '''
+    WITH ranked AS (
+        SELECT id, key, used_at, row_number() OVER (ORDER BY used_at DESC NULLS LAST, id DESC) AS n
+        FROM public.orders
+        WHERE status = 2 AND key IS NOT NULL
+    )
+    UPDATE public.orders o
+    SET key = NULL
+    FROM ranked r
+    WHERE o.id = r.id AND (r.n > $1 OR r.used_at < now() - $2 * interval '1 second')
+    RETURNING o.id, o.path, r.key,
+        EXISTS(SELECT 1 FROM public.playlist p WHERE p.turn_id = o.id AND p.status = 3) AS saved
+    '''
+)
+DELETE_ORDER = db.query(
+    'orders.delete',
+    '''
+    DELETE
+    FROM public.orders
+    WHERE id = $1
+    '''
+)
+ORDER_STATUS = db.query(
+    'orders.status',
+    '''
+    SELECT status
+    FROM public.orders
+    WHERE id = $1
+    '''
+)
+CLAIM_ORDER = db.query(
+    'orders.claim',
+    '''
+    WITH o AS (
+        UPDATE public.orders
+        SET status = 1
+        WHERE id = $1 AND status < 2
+        RETURNING id, words, key, genre
+    ), p AS (
+        UPDATE public.playlist
+        SET status = 1
+        WHERE turn_id = $1 AND status < 2
+    )
+    SELECT id, words, key, genre
+    FROM o
+    '''
+)
+FINISH_ORDER = db.query(
+    'orders.finish',
+    '''
+    WITH o AS (
+        UPDATE public.orders
+        SET status = $2, url = coalesce($3, url), path = coalesce($4, path), used_at = now()
+        WHERE id = $1
+    )
+    UPDATE public.playlist p
+    SET status = $2, url = coalesce($3, p.url)
+    FROM public.customers c
+    WHERE p.turn_id = $1 AND p.status < 2 AND c.id = p.customer_id
+    RETURNING p.id, p.customer_id, p.status, p.url, c.uid AS chat_id
+    '''
+)
+PENDING_ORDERS = db.query(
+    'orders.pending',
+    '''
+    SELECT id
+    FROM public.orders
+    WHERE status < 2
+    ORDER BY id
+    '''
+)
+INSERT_PLAYLIST = db.query(
+    'playlist.insert',
+    '''
+    INSERT INTO public.playlist(customer_id, words, turn_id, status, url)
+    VALUES ($1, $2, $3, $4, $5)
+    RETURNING *
+    '''
+)
+# Плейлист к чужому заказу: статус и url берутся из заказа в том же запросе. FOR SHARE ждет
+# незавершенный finish и читает уже итоговый статус; finish, в свою очередь, блокирует заказ
+# до обновления плейлистов (LOCK_ORDER), поэтому плейлист не может остаться PENDING навсегда
+ATTACH_PLAYLIST = db.query(
+    'playlist.attach',
+    '''
+    INSERT INTO public.playlist(customer_id, words, turn_id, status, url)
+    SELECT $1, $2, o.id, o.status, o.url
+    FROM public.orders o
+    WHERE o.id = $3
+    FOR SHARE
+    RETURNING *
+    '''
+)
+LOCK_ORDER = db.query(
+    'orders.lock',
+    '''
+    SELECT id
+    FROM public.orders
+    WHERE id = $1
+    FOR UPDATE
+    '''
+)
+
+
+class StubBackend:
+    # Локальная заглушка для тестов и разработки: через delay секунд отдает url
+    # из настроек или случайный активный трек из tunes
+
+    def __init__(self, delay=5, url=None, **_):
+        self.delay = delay
+        self.url = url
+
+    async def generate(self, words, genre=None) -> str:
+        await asyncio.sleep(self.delay)
+        if self.url:
+            return self.url
+
+        await tunes.load()
+        if not tunes.tunes:
+            raise ValueError('no tunes for stub generation')
+
+        tune = tunes.tunes[random.choice(list(tunes.tunes))]
+        return settings['base_url'] + '/static/uploads/' + tune['path']
+
+
+class ReplicateBackend:
+    # Генерация моделью на replicate.com. Клиент синхронный, поэтому вызов идет в пуле потоков
+
+    def __init__(self, token=None, model='meta/musicgen', duration=30, **_):
+        self.client = replicate.Client(api_token=token)
+        self.model = model
+        self.duration = duration
+
+    async def generate(self, words, genre=None) -> str:
+        output = await asyncio.get_event_loop().run_in_executor(
+            None,
+            lambda: self.client.run(self.model, input={
+                'prompt': ', '.join(([genre] if genre else []) + list(words)),
+                'duration': self.duration,
+            })
+        )
+        if isinstance(output, (list, tuple)):
+            output = output[0] if output else None
+        if not output:
+            raise ValueError('empty replicate output')
+        return str(output)
+
+
+class GenerationQueue:
+    # Заказ (orders) - задача генерации, плейлисты клиентов ссылаются на него через turn_id.
+    # Одинаковые наборы слов, пока заказ не готов, присоединяются к нему. Очередь в Redis:
+    # взятая задача держит lease и лежит в множестве processing; если воркер упал, recover
+    # вернет ее в очередь после истечения lease, а незавершенные заказы из БД - если Redis их потерял
+    #
+    # Готовые треки - кэш результатов по тому же ключу (жанр + отсортированные слова): новый запрос
+    # с таким ключом сразу получает готовый трек. Внешние результаты скачиваются в storage, чтобы
+    # ссылки не протухали. Раз в EVICT_INTERVAL из кэша выводятся записи старше cache_max_age и
+    # сверх cache_max_entries по давности использования; файл освобождается, если трек никто не сохранил
+    PREFIX = 'art:generation'
+    LEASE_TTL = 600
+    DEDUP_TTL = 60 * 60
+    RESULT_TTL = 60 * 60 * 24
+    RECOVER_INTERVAL = 60
+    EVICT_INTERVAL = 60 * 60
+    BACKOFF = 5
+
+    BACKENDS = {
+        'stub': StubBackend,
+        'replicate': ReplicateBackend,
+    }
+
+    def __init__(self):
+        self.backend = None
+        self.workers = []
+        self.recovery = None
+        self.closing = False
+        self.wakeup = None
+        self.notify = None
+
+        self.timeout = 300
+        self.max_attempts = 3
+        self.persist = True
+        self.cache_max_entries = 1000
+        self.cache_max_age = 60 * 60 * 24 * 30
+
+        self.running = 0
+        self.submitted = 0
+        self.deduplicated = 0
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    @property
+    def queue_key(self):
+        return f'{self.PREFIX}:queue'
+
+    @property
+    def processing_key(self):
+        return f'{self.PREFIX}:processing'
+
+    @property
+    def lease_prefix(self):
+        return f'{self.PREFIX}:lease:'
+
+    @property
+    def attempts_key(self):
+        return f'{self.PREFIX}:attempts'
+
+    def words_key(self, key):
+        return f'{self.PREFIX}:words:{key}'
+
+    def result_key(self, key):
+        return f'{self.PREFIX}:result:{key}'
+
+    @classmethod
+    def canonical(cls, words, genre=None) -> str:  # Ключ набора: порядок и повторы слов не важны
+        return text_to_hash(f'{genre or ""}|' + ' '.join(sorted(set(words))))
+
+    async def initialize(
+        self,
+        backend='stub',
+        workers=2,
+        timeout=300,
+        max_attempts=3,
+        persist=True,
+        cache_max_entries=1000,
+        cache_max_age=60 * 60 * 24 * 30,
+        notify=None,
+        **options
+    ):
+        self.backend = self.BACKENDS[backend](**options)
+        self.timeout = min(timeout, self.LEASE_TTL - 10)
+        self.max_attempts = max_attempts
+        self.persist = persist
+        self.cache_max_entries = cache_max_entries
+        self.cache_max_age = cache_max_age
+        self.notify = notify
+        self.closing = False
+        self.wakeup = asyncio.Event()
+
+        await self.recover()
+
+        self.workers = [asyncio.ensure_future(self.worker()) for _ in range(workers)]
+        self.recovery = asyncio.ensure_future(self.recoverer())
+
+    async def close(self, timeout=10):
+        self.closing = True
+        if self.recovery is not None:
+            self.recovery.cancel()
+            self.recovery = None
+        if self.workers:
+            # Незаконченные задачи отменяются и сразу возвращаются в очередь (см. worker)
+            _, pending = await asyncio.wait(self.workers, timeout=timeout)
+            for x in pending:
+                x.cancel()
+            if pending:
+                await asyncio.wait(pending)
+        self.workers = []
+
+    async def submit(self, customer_id, chat_id, words, genre=None) -> dict:
+        # Поставить генерацию и вернуть плейлист клиента; для готового результата - сразу со status READY
+        words = sorted(set(words))
+        key = self.canonical(words, genre)
+        self.submitted += 1
+
+        result = await self.cached(key)
+        if result:
+            self.hits += 1
+            await writer.write(TOUCH_ORDER, result['id'])
+            playlist = dict(await db.fetchrow(INSERT_PLAYLIST, customer_id, words, result['id'], READY, result['url']))
+            await self.notify_playlist({**playlist, 'chat_id': chat_id})
+            return playlist
+        self.misses += 1
+
+        words_key = self.words_key(key)
+        order_id = IntUtils.to_int(await cache.get(words_key))
+        if order_id and IntUtils.to_int(await db.fetchval(ORDER_STATUS, order_id), default=FAILED) < READY:
+            playlist = await self.attach(customer_id, chat_id, words, order_id)
+            if playlist:
+                return playlist
+        if order_id:
+            await cache.delete(words_key)  # заказ уже завершен
+
+        order_id = await db.fetchval(INSERT_ORDER, chat_id, words, key, genre)
+        if not await cache.set(words_key, order_id, expire=self.DEDUP_TTL, exist='SET_IF_NOT_EXIST'):
+            winner_id = IntUtils.to_int(await cache.get(words_key))
+            if winner_id and winner_id != order_id:
+                playlist = await self.attach(customer_id, chat_id, words, winner_id)
+                if playlist:
+                    await db.execute(DELETE_ORDER, order_id)
+                    return playlist
+
+        playlist = dict(await db.fetchrow(INSERT_PLAYLIST, customer_id, words, order_id, PENDING, None))
+        await cache.rpush(self.queue_key, order_id)
+        if self.wakeup is not None:
+            self.wakeup.set()
+        return playlist
+
+    async def attach(self, customer_id, chat_id, words, order_id) -> dict:  # Присоединиться к чужому заказу
+        playlist = await db.fetchrow(ATTACH_PLAYLIST, customer_id, words, order_id)
+        if not playlist:
+            return {}  # заказ удален
+
+        self.deduplicated += 1
+        playlist = dict(playlist)
+        if playlist['status'] >= READY:  # заказ успел завершиться: finish этот плейлист уже не увидит
+            await self.notify_playlist({**playlist, 'chat_id': chat_id})
+        return playlist
+
+    async def take(self, timeout=1):
+        order_id = await cache.eval(
+            TAKE_SCRIPT,
+            keys=[self.queue_key, self.processing_key, self.lease_prefix],
+            args=['1', self.LEASE_TTL]
+        )
+        if order_id is None:
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            return None
+
+        return IntUtils.to_int(order_id)  # '' - задача уже выполняется другим воркером
+
+    async def release(self, order_id, requeue=False):
+        await cache.eval(
+            RELEASE_SCRIPT,
+            keys=[self.queue_key, self.processing_key, f'{self.lease_prefix}{order_id}'],
+            args=[order_id, '1' if requeue else '0']
+        )
+
+    async def worker(self):
+        while not self.closing:
+            try:
+                order_id = await self.take()
+            except Exception as e:
+                print(f'[generation] {e}')
+                await asyncio.sleep(1)
+                continue
+
+            if not order_id:
+                continue
+
+            self.running += 1
+            try:
+                requeue = await self.process(order_id)
+            except asyncio.CancelledError:
+                await asyncio.shield(self.release(order_id, requeue=True))
+                raise
+            except Exception as e:
+                print(f'[generation] {order_id}: {e}')
+                await asyncio.sleep(1)
+                requeue = True
+            finally:
+                self.running -= 1
+
+            try:
+                await self.release(order_id, requeue=requeue)
+            except Exception as e:
+                print(f'[generation] {e}')
+
+    async def process(self, order_id) -> bool:  # True - повторить позже
+        order = await db.fetchrow(CLAIM_ORDER, order_id)
+        if not order:
+            return False  # заказ уже готов или удален
+
+        path = None
+        try:
+            url = await asyncio.wait_for(self.backend.generate(order['words'] or [], genre=order['genre']), self.timeout)
+            if self.persist and not url.startswith(self.local_prefix):
+                path = await self.download(url)
+                url = self.local_prefix + path
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            attempts = IntUtils.to_int(await cache.hincrby(self.attempts_key, order_id, 1))
+            print(f'[generation] {order_id} attempt {attempts}: {e!r}')
+            if attempts < self.max_attempts:
+                self.retried += 1
+                await asyncio.sleep(self.BACKOFF * attempts)
+                return True
+
+            self.failed += 1
+            await self.finish(order, FAILED)
+            return False
+
+        self.completed += 1
+        await self.finish(order, READY, url, path)
+        return False
+
+    @property
+    def local_prefix(self):
+        return settings['base_url'] + '/static/uploads/'
+
+    async def download(self, url) -> str:  # Скачать внешний результат в storage, вернуть путь
+        name = url.split('?')[0].rsplit('/', 1)[-1] or 'track.mp3'
+        upload = await storage.save(name, client.iter_content(url))
+        return upload['file_name']
+
+    async def finish(self, order, status, url=None, path=None):
+        order_id = order['id']
+        async with db.connection(transaction=True):
+            # Сначала блокировка заказа: FINISH_ORDER увидит все плейлисты, присоединенные до нее
+            await db.execute(LOCK_ORDER, order_id)
+            playlists = await db.fetch(FINISH_ORDER, order_id, status, url, path)
+
+        await cache.hdel(self.attempts_key, order_id)
+        if order['key']:
+            words_key = self.words_key(order['key'])
+            if IntUtils.to_int(await cache.get(words_key)) == order_id:
+                await cache.delete(words_key)
+            if status == READY:
+                await cache.setex(self.result_key(order['key']), self.RESULT_TTL, ujson.dumps({'id': order_id, 'url': url}))
+
+        for playlist in playlists:
+            await self.notify_playlist(dict(playlist))
+
+    async def notify_playlist(self, playlist):
+        if self.notify is None:
+            return
+
+        try:
+            result = self.notify(playlist)
+            if isawaitable(result):
+                await result
+        except Exception as e:
+            print(f'[generation] notify {playlist["id"]}: {e}')
+
+    async def cached(self, key) -> dict:  # Готовый результат для ключа: Redis, затем индекс orders
+        result = await cache.get(self.result_key(key))
+        if result:
+            return ujson.loads(result)
+
+        order = await db.fetchrow(CACHED_ORDER, key)
+        if not order or not order['url']:
+            return {}
+
+        result = {'id': order['id'], 'url': order['url']}
+        await cache.setex(self.result_key(key), self.RESULT_TTL, ujson.dumps(result))
+        return result
+
+    async def evict(self) -> int:
+        if not await cache.set(f'{self.PREFIX}:evict', '1', expire=self.EVICT_INTERVAL, exist='SET_IF_NOT_EXIST'):
+            return 0
+
+        evicted = 0
+        for x in await db.fetch(EVICT_ORDERS, self.cache_max_entries, self.cache_max_age):
+            await cache.delete(self.result_key(x['key']))
+            if x['path'] and not x['saved']:
+                await storage.release(x['path'])
+            evicted += 1
+
+        self.evicted += evicted
+        return evicted
+
+    async def recover(self) -> int:
+        if not await cache.set(f'{self.PREFIX}:recover', '1', expire=self.RECOVER_INTERVAL, exist='SET_IF_NOT_EXIST'):
+            return 0
+
+        recovered = 0
+        for order_id in await cache.smembers(self.processing_key) or []:
+            recovered += await cache.eval(
+                RECOVER_SCRIPT,
+                keys=[self.queue_key, self.processing_key, f'{self.lease_prefix}{order_id}'],
+                args=[order_id]
+            )
+
+        # Заказы, которых нет ни в очереди, ни в работе (например, Redis потерял данные)
+        known = set(await cache.lrange(self.queue_key, 0, -1) or []) | set(await cache.smembers(self.processing_key) or [])
+        for x in await db.fetch(PENDING_ORDERS):
+            if str(x['id']) not in known:
+                await cache.rpush(self.queue_key, x['id'])
+                recovered += 1
+
+        if recovered:
+            print(f'[generation] recovered {recovered} jobs')
+            if self.wakeup is not None:
+                self.wakeup.set()
+        return recovered
+
+    async def recoverer(self):
+        while True:
+            await asyncio.sleep(self.RECOVER_INTERVAL)
+            try:
+                await self.recover()
+                await self.evict()
+            except Exception as e:
+                print(f'[generation] {e}')
+
+    async def stats(self) -> dict:
+        return {
+            'queued': IntUtils.to_int(await cache.llen(self.queue_key), default=0),
+            'processing': IntUtils.to_int(await cache.scard(self.processing_key), default=0),
+            'workers': len(self.workers),
+            'running': self.running,
+            'submitted': self.submitted,
+            'deduplicated': self.deduplicated,
+            'completed': self.completed,
+            'failed': self.failed,
+            'retried': self.retried,
+            'cache': {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / (self.hits + self.misses), 3) if self.hits + self.misses else 0,
+                'evicted': self.evicted,
+            },
+        }
+
+
+generation = GenerationQueue()
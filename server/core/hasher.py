@@ -13,3 +13,12 @@ def password_to_hash(password) -> Optional[str]:
         return hasher.hexdigest()
     else:
         return None
+
+
+def text_to_hash(text) -> Optional[str]:
+    if isinstance(text, str):
+        hasher = md5()
+        hasher.update(text.encode())
+        return hasher.hexdigest()
+    else:
+        return None
@@ -1,33 +1,122 @@
 import aiohttp
 
+__all__ = ['client', 'request']
+
+
+class HTTPClient:
+
+    def __init__(self):
+        self.session = None
+        self.connector = None
+
+        self.requests = 0
+        self.errors = 0
+
+    async def initialize(self, limit=100, limit_per_host=30, ttl_dns_cache=300, keepalive_timeout=60):
+        self.connector = aiohttp.TCPConnector(
+            limit=limit,
+            limit_per_host=limit_per_host,
+            ttl_dns_cache=ttl_dns_cache,
+            use_dns_cache=True,
+            keepalive_timeout=keepalive_timeout,
+        )
+
+        self.session = aiohttp.ClientSession(
+            connector=self.connector,
+            timeout=aiohttp.ClientTimeout(connect=5, total=10)
+        )
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+        self.session = None
+        self.connector = None
+
+    def stats(self) -> dict:
+        connector = self.connector
+        if connector is None or connector.closed:
+            return {}
+
+        hosts = {}
+        for key, conns in connector._acquired_per_host.items():
+            hosts.setdefault(f'{key.host}:{key.port}', {'acquired': 0, 'idle': 0})['acquired'] += len(conns)
+        for key, conns in connector._conns.items():
+            hosts.setdefault(f'{key.host}:{key.port}', {'acquired': 0, 'idle': 0})['idle'] += len(conns)
+
+        return {
+            'limit': connector.limit,
+            'limit_per_host': connector.limit_per_host,
+            'acquired': len(connector._acquired),
+            'idle': sum(x['idle'] for x in hosts.values()),
+            'hosts': hosts,
+            'requests': self.requests,
+            'errors': self.errors,
+        }
+
+    async def request(self, method, url, **kwargs):
+        self.requests += 1
+
+        if self.session is None:
+            # Вне сервера (скрипты) пул не инициализирован, работаем через временную сессию
+            try:
+                async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(connect=5, total=10)) as session:
+                    return await self._request(session, method, url, **kwargs)
+            except Exception as e:
+                print(e)
+                self.errors += 1
+                return False, None
+
+        return await self._request(self.session, method, url, **kwargs)
+
+    async def iter_content(self, url, chunk_size=64 * 1024, timeout=120):  # Скачивание файла кусками
+        self.requests += 1
+
+        session = self.session
+        close = session is None
+        if close:
+            session = aiohttp.ClientSession()
+
+        try:
+            async with session.get(url, timeout=aiohttp.ClientTimeout(connect=5, total=timeout)) as response:
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    yield chunk
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            if close:
+                await session.close()
+
+    async def _request(self, session, method, url, **kwargs):
+        if method == 'get':
+            handler = session.get
+        elif method == 'post':
+            handler = session.post
+        else:
+            handler = getattr(session, method)
+        try:
+            async with handler(url, **kwargs) as response:
+                try:
+                    data = await response.json()
+                    return True, data
+                except Exception as e:
+                    print(e)
+                    self.errors += 1
+                    return False, None
+        except Exception as e:
+            print(e)
+            self.errors += 1
+            return False, None
+
+
+client = HTTPClient()
+
 
 async def request(
     method,
     url,
     **kwargs
 ):
-    session_params, request_params = {
-        'timeout': aiohttp.ClientTimeout(connect=5, total=10)
-    }, {}
-    try:
-        async with aiohttp.ClientSession(**session_params) as session:
-            if method == 'get':
-                handler = session.get
-            elif method == 'post':
-                handler = session.post
-            else:
-                handler = getattr(session, method)
-            try:
-                async with handler(url, **kwargs) as response:
-                    try:
-                        data = await response.json()
-                        return True, data
-                    except Exception as e:
-                        print(e)
-                        return False, None
-            except Exception as e:
-                print(e)
-                return False, None
-    except Exception as e:
-        print(e)
-        return False, None
+    return await client.request(method, url, **kwargs)
@@ -0,0 +1,200 @@
+import asyncio
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import ujson
+from pymystem3 import Mystem
+
+from core.cache import cache
+from core.hasher import text_to_hash
+from core.lru import LRUCache
+
+__all__ = ['lemmatizer']
+
+SEPARATOR = '|||'  # Разделитель текстов внутри одного вызова Mystem
+
+
+class Lemmatizer:
+    # Пул процессов Mystem вне event loop. Каждый воркер владеет своим процессом и забирает
+    # из очереди все накопившиеся запросы, отправляя их в Mystem одной строкой
+
+    def __init__(self):
+        self.executor = None
+        self.pending = None
+        self.workers = []
+        self.instances = []
+        self.timeout = 5
+        self.batch_size = 32
+
+        self.mystem = None
+        self.fallback_lock = None
+
+        self.lemmas = LRUCache(maxsize=10000)
+        self.share = False
+        self.share_ttl = 60 * 60 * 24
+        self.shared_hits = 0
+
+        self.calls = 0
+        self.batches = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.fallbacks = 0
+        self.splits = 0
+
+    async def initialize(self, workers=2, queue_size=100, timeout=5, batch_size=32, cache_size=10000, share=False):
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.lemmas = LRUCache(maxsize=cache_size)
+        self.share = share
+
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='mystem')
+        self.pending = asyncio.Queue(maxsize=queue_size)
+        self.fallback_lock = asyncio.Lock()
+        self.instances = [Mystem() for _ in range(workers)]
+        self.workers = [asyncio.ensure_future(self.worker(x)) for x in self.instances]
+
+    async def close(self):
+        for x in self.workers:
+            x.cancel()
+        self.workers = []
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+        for x in self.instances:
+            x.close()
+        self.instances = []
+        self.pending = None
+
+    @classmethod
+    def normalize(cls, text) -> str:
+        return ' '.join((text or '').lower().split())
+
+    async def lemmatize(self, text) -> list:
+        key = self.normalize(text)
+
+        lemmas = self.lemmas.get(key)
+        if lemmas is not None:
+            return lemmas
+
+        if self.share:
+            lemmas = await cache.get(f'art:lemmas:{text_to_hash(key)}')
+            if lemmas:
+                self.shared_hits += 1
+                lemmas = ujson.loads(lemmas)
+                self.lemmas.set(key, lemmas)
+                return lemmas
+
+        lemmas = await self.submit(key)
+        if lemmas is None:
+            # Без лемм проверка на фразы риска молча пропускается, поэтому пустой список не возвращаем
+            lemmas = await self.fallback(key)
+            if lemmas is None:
+                self.splits += 1
+                return re.findall(r'\w+', key)
+
+        self.lemmas.set(key, lemmas)
+        if self.share:
+            await cache.setex(f'art:lemmas:{text_to_hash(key)}', self.share_ttl, ujson.dumps(lemmas))
+
+        return lemmas
+
+    async def warmup(self, texts) -> int:
+        texts = list({self.normalize(x) for x in texts if x})
+        for i in range(0, len(texts), self.batch_size):
+            await asyncio.gather(*[self.lemmatize(x) for x in texts[i:i + self.batch_size]])
+        return len(texts)
+
+    async def submit(self, text):
+        self.calls += 1
+
+        if self.pending is None:
+            # Пул не запущен (скрипты), лемматизируем синхронно
+            if self.mystem is None:
+                self.mystem = Mystem()
+            return self.mystem.lemmatize(text)
+
+        future = asyncio.get_event_loop().create_future()
+        try:
+            self.pending.put_nowait((text, future))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            print('[lemmatizer] queue is full')
+            return None
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            print(f'[lemmatizer] timeout: {text}')
+            return None
+
+    async def fallback(self, text):
+        # Пул перегружен или не ответил: отдельный процесс Mystem вне пула, по одному запросу.
+        # Если и он занят или упал - None, вызывающий разобьет текст на слова
+        if self.fallback_lock is None or self.fallback_lock.locked():
+            return None
+
+        self.fallbacks += 1
+        async with self.fallback_lock:
+            try:
+                if self.mystem is None:
+                    self.mystem = Mystem()
+                return await asyncio.get_event_loop().run_in_executor(None, self.mystem.lemmatize, text)
+            except Exception as e:
+                print(f'[lemmatizer] fallback: {e}')
+                return None
+
+    async def worker(self, mystem):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.pending.get()]
+            while len(batch) < self.batch_size and not self.pending.empty():
+                batch.append(self.pending.get_nowait())
+
+            self.batches += 1
+            try:
+                results = await loop.run_in_executor(self.executor, self.process, mystem, [x[0] for x in batch])
+            except Exception as e:
+                print(f'[lemmatizer] {e}')
+                results = [None for _ in batch]
+
+            for (_, future), lemmas in zip(batch, results):
+                if not future.done():
+                    future.set_result(lemmas)
+
+    @classmethod
+    def process(cls, mystem, texts) -> list:
+        line = f' {SEPARATOR} '.join(' '.join(x.replace('|', ' ').split()) for x in texts)
+
+        results = [[]]
+        for token in mystem.lemmatize(line):
+            if SEPARATOR in token:
+                for _ in range(token.count(SEPARATOR)):
+                    results.append([])
+            else:
+                results[-1].append(token)
+
+        if len(results) != len(texts):
+            # Разделитель съеден или размножен Mystem: по одному, чтобы не перепутать леммы разных текстов
+            return [mystem.lemmatize(x) for x in texts]
+
+        return results
+
+    def stats(self) -> dict:
+        return {
+            'workers': len(self.workers),
+            'queued': self.pending.qsize() if self.pending else 0,
+            'calls': self.calls,
+            'batches': self.batches,
+            'timeouts': self.timeouts,
+            'rejected': self.rejected,
+            'fallbacks': self.fallbacks,
+            'splits': self.splits,
+            'cache': self.lemmas.stats(),
+            'shared_hits': self.shared_hits,
+        }
+
+
+lemmatizer = Lemmatizer()
@@ -0,0 +1,49 @@
+__all__ = ['PhraseMatcher']
+
+
+class PhraseMatcher:
+    # Инвертированный индекс: лемма -> фразы, в которые она входит.
+    # Фраза найдена, когда в тексте встретились все ее леммы (порядок не важен)
+
+    def __init__(self, phrases=None):
+        self.phrases = ()
+        self.sizes = ()
+        self.index = {}
+
+        self.load(phrases or [])
+
+    def load(self, phrases):
+        unique, loaded, index, sizes = [], set(), {}, []
+        for phrase in phrases:
+            lemmas = tuple(phrase)
+            if not lemmas or lemmas in loaded:
+                continue
+            loaded.add(lemmas)
+
+            for lemma in set(lemmas):
+                index.setdefault(lemma, []).append(len(unique))
+            sizes.append(len(set(lemmas)))
+            unique.append(lemmas)
+
+        self.phrases, self.sizes, self.index = tuple(unique), tuple(sizes), index
+
+    def match(self, lemmas) -> list:  # [(фраза, позиция леммы, на которой фраза совпала)]
+        index, sizes, phrases = self.index, self.sizes, self.phrases
+        counts, seen, matches = {}, set(), []
+
+        for position, lemma in enumerate(lemmas):
+            ids = index.get(lemma)
+            if not ids or lemma in seen:
+                continue
+            seen.add(lemma)
+
+            for i in ids:
+                n = counts.get(i, 0) + 1
+                counts[i] = n
+                if n == sizes[i]:
+                    matches.append((phrases[i], position))
+
+        return matches
+
+    def __len__(self) -> int:
+        return len(self.phrases)
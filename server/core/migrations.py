@@ -0,0 +1,168 @@
+import asyncio
+import os
+
+import asyncpg
+
+from core.db import db
+from core.hasher import text_to_hash
+from settings import settings
+
+__all__ = ['migrations', 'SchemaOutdated']
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'migrations')
+
+
+class SchemaOutdated(Exception):
+    pass
+
+
+class Migrations:
+    # Версионные миграции из MIGRATIONS_DIR: файлы NNNN_name.sql применяются по порядку,
+    # каждый в своей транзакции, примененные записываются в schema_migrations.
+    # Несколько воркеров не применяют миграции одновременно благодаря advisory lock.
+    # Без всех миграций и индексов сервер не стартует: запросы на них рассчитаны (ON CONFLICT, risk_words)
+    LOCK_ID = 20200901
+
+    # Индексы, на которые рассчитаны запросы вебхука
+    EXPECTED_INDEXES = (
+        'customers_uid_uindex',
+        'playlist_customer_id_id_saved_index',
+        'kbase_title_index',
+        'kbase_type_index',
+        'questions_category_id_index',
+        'uploads_path_uindex',
+        'orders_key_ready_index',
+        'playlist_turn_id_index',
+    )
+
+    def __init__(self, path=MIGRATIONS_DIR):
+        self.path = path
+
+    def files(self) -> list:
+        items = []
+        for name in sorted(os.listdir(self.path)):
+            version, _, title = name.partition('_')
+            if not name.endswith('.sql') or not version.isdigit():
+                continue
+
+            with open(os.path.join(self.path, name), encoding='utf-8') as f:
+                sql = f.read()
+
+            items.append({
+                'version': int(version),
+                'name': title[:-4],
+                'sql': sql,
+                'checksum': text_to_hash(sql),
+            })
+        return items
+
+    async def migrate(self, conn) -> list:
+        # Сначала lock: параллельные CREATE TABLE IF NOT EXISTS из нескольких воркеров конфликтуют в каталоге
+        await conn.execute('SELECT pg_advisory_lock($1)', self.LOCK_ID)
+        try:
+            await conn.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS public.schema_migrations
+                (
+                    version    integer primary key,
+                    name       text,
+                    checksum   text,
+                    applied_at timestamp default now() not null
+                )
+                '''
+            )
+
+            applied = {
+                x['version']: x['checksum']
+                for x in await conn.fetch('SELECT version, checksum FROM public.schema_migrations')
+            }
+
+            done = []
+            for item in self.files():
+                if item['version'] in applied:
+                    if applied[item['version']] != item['checksum']:
+                        print(f'[migrations] {item["version"]:04d}_{item["name"]} changed after it was applied')
+                    continue
+
+                async with conn.transaction():
+                    await conn.execute(item['sql'])
+                    await conn.execute(
+                        '''
+                        INSERT INTO public.schema_migrations(version, name, checksum)
+                        VALUES ($1, $2, $3)
+                        ''',
+                        item['version'],
+                        item['name'],
+                        item['checksum']
+                    )
+
+                print(f'[migrations] applied {item["version"]:04d}_{item["name"]}')
+                done.append(item['version'])
+
+            return done
+        finally:
+            await conn.execute('SELECT pg_advisory_unlock($1)', self.LOCK_ID)
+
+    async def pending(self, conn) -> list:  # Не примененные миграции: ['0006_order_genre', ...]
+        applied = set()
+        if await conn.fetchval("SELECT to_regclass('public.schema_migrations')") is not None:
+            applied = {x['version'] for x in await conn.fetch('SELECT version FROM public.schema_migrations')}
+
+        return [f'{x["version"]:04d}_{x["name"]}' for x in self.files() if x['version'] not in applied]
+
+    async def missing_indexes(self, conn) -> list:
+        existing = {
+            x['indexname']
+            for x in await conn.fetch(
+                '''
+                SELECT indexname
+                FROM pg_indexes
+                WHERE schemaname = 'public' AND indexname = ANY($1::text[])
+                ''',
+                list(self.EXPECTED_INDEXES)
+            )
+        }
+        return [x for x in self.EXPECTED_INDEXES if x not in existing]
+
+    async def check(self, migrate=False):  # Проверка при старте сервера
+        async with db.pool.acquire() as conn:
+            if migrate:
+                await self.migrate(conn)
+
+            pending = await self.pending(conn)
+            missing = await self.missing_indexes(conn)
+
+        problems = []
+        if pending:
+            problems.append(f'pending migrations: {", ".join(pending)}')
+        if missing:
+            problems.append(f'missing indexes: {", ".join(missing)}')
+
+        if problems:
+            message = '; '.join(problems)
+            print(f'[migrations] {message}; run python -m core.migrations or set db.migrate')
+            raise SchemaOutdated(message)
+
+
+migrations = Migrations()
+
+
+async def main():
+    conn = await asyncpg.connect(
+        database=settings.get('db', {}).get('database', 'maindb'),
+        host=settings.get('db', {}).get('host', '127.0.0.1'),
+        port=settings.get('db', {}).get('port', 5432),
+        user=settings.get('db', {}).get('user', 'postgres'),
+        password=settings.get('db', {}).get('password', '1234'),
+    )
+    try:
+        await migrations.migrate(conn)
+        missing = await migrations.missing_indexes(conn)
+        if missing:
+            print(f'[migrations] missing indexes: {", ".join(missing)}')
+    finally:
+        await conn.close()
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,98 @@
+import re
+
+__all__ = ['MultipartReader', 'get_boundary']
+
+PARAMS_PATTERN = re.compile(r'(\w+)="([^"]*)"|(\w+)=([^;\s]+)')
+
+
+def parse_params(value) -> dict:  # 'form-data; name="file"; filename="a.mp3"' -> {'name': 'file', 'filename': 'a.mp3'}
+    params = {}
+    for quoted_key, quoted_value, key, _value in PARAMS_PATTERN.findall(value or ''):
+        params[(quoted_key or key).lower()] = quoted_value if quoted_key else _value
+    return params
+
+
+def get_boundary(content_type):
+    if not (content_type or '').lower().startswith('multipart/form-data'):
+        return None
+    boundary = parse_params(content_type).get('boundary')
+    return boundary.encode() if boundary else None
+
+
+class MultipartReader:
+    # Разбор multipart/form-data по мере чтения тела запроса: в памяти только текущий кусок
+    # и хвост длиной в разделитель, поэтому размер файла на потребление памяти не влияет
+    MAX_HEADERS_SIZE = 16 * 1024
+
+    def __init__(self, stream, boundary):
+        self.stream = stream
+        self.delimiter = b'\r\n--' + boundary
+        self.buffer = bytearray(b'\r\n')  # первый разделитель идет без CRLF перед ним
+        self.eof = False
+        self.finished = False
+
+    async def fill(self):
+        if self.eof:
+            raise ValueError('Unexpected end of multipart body')
+
+        chunk = await self.stream.read()
+        if chunk is None:
+            self.eof = True
+        else:
+            self.buffer += chunk
+
+    async def next_part(self):  # Заголовки следующей части или None, если частей больше нет
+        if self.finished:
+            return None
+
+        while True:
+            index = self.buffer.find(self.delimiter)
+            if index >= 0:
+                break
+            del self.buffer[:max(0, len(self.buffer) - len(self.delimiter))]
+            await self.fill()
+
+        end = index + len(self.delimiter)
+        while len(self.buffer) < end + 2:
+            await self.fill()
+
+        if self.buffer[end:end + 2] == b'--':
+            self.finished = True
+            return None
+
+        while True:
+            index = self.buffer.find(b'\r\n\r\n', end)
+            if index >= 0:
+                break
+            if len(self.buffer) > end + self.MAX_HEADERS_SIZE:
+                raise ValueError('Multipart headers are too large')
+            await self.fill()
+
+        headers = {}
+        for line in bytes(self.buffer[end + 2:index]).decode('utf-8', 'replace').split('\r\n'):
+            key, _, value = line.partition(':')
+            if key:
+                headers[key.strip().lower()] = value.strip()
+
+        del self.buffer[:index + 4]
+        return headers
+
+    async def read_part(self):  # Содержимое текущей части кусками
+        while True:
+            index = self.buffer.find(self.delimiter)
+            if index >= 0:
+                if index:
+                    yield bytes(self.buffer[:index])
+                    del self.buffer[:index]
+                return
+
+            safe = len(self.buffer) - len(self.delimiter) + 1
+            if safe > 0:
+                yield bytes(self.buffer[:safe])
+                del self.buffer[:safe]
+
+            await self.fill()
+
+    @classmethod
+    def disposition(cls, headers) -> dict:
+        return parse_params(headers.get('content-disposition'))
@@ -14,6 +14,14 @@ class Pager:
     _offset = None
     _query = None
 
+    # Keyset-режим: курсор - значение колонки последней (after) или первой (before) строки страницы
+    cursor = None
+    direction = 'after'
+    has_next = False
+    has_prev = False
+    next_cursor = None
+    prev_cursor = None
+
     def set_page(self, page, default=DEFAULT_PAGE, minimum=1, maximum=None) -> 'Pager':
         self.page = self._sanitize(
             value=page,
@@ -57,6 +65,47 @@ class Pager:
         self.limit = None
         return self
 
+    def set_cursor(self, cursor, direction='after') -> 'Pager':
+        self.cursor = IntUtils.to_int(cursor)
+        self.direction = direction if direction in ('after', 'before') else 'after'
+        return self
+
+    def reset_cursor(self) -> 'Pager':
+        self.cursor = None
+        self.direction = 'after'
+        return self
+
+    def _keyset_desc(self, order) -> bool:
+        desc = order.lower() == 'desc'
+        return not desc if self.direction == 'before' else desc
+
+    # Example: 'AND p.id < 120' или 'AND p.id < $2' с param='$2', чтобы текст запроса не зависел от курсора
+    def as_keyset_condition(self, column='id', order='desc', prefix='AND', param=None) -> str:
+        if self.cursor is None:
+            return ''
+        sign = '<' if self._keyset_desc(order) else '>'
+        return f'{prefix} {column} {sign} {param or self.cursor}'
+
+    # Example: 'ORDER BY p.id DESC LIMIT 21', лишняя строка нужна для has_next без count(*)
+    def as_keyset_query(self, column='id', order='desc') -> str:
+        direction = 'DESC' if self._keyset_desc(order) else 'ASC'
+        return f'ORDER BY {column} {direction} LIMIT {self.limit + 1}'
+
+    def set_rows(self, rows, column='id') -> list:
+        rows = list(rows or [])
+        has_more = len(rows) > self.limit
+        rows = rows[:self.limit]
+
+        if self.direction == 'before':
+            rows.reverse()
+            self.has_prev, self.has_next = has_more, self.cursor is not None
+        else:
+            self.has_prev, self.has_next = self.cursor is not None, has_more
+
+        self.prev_cursor = rows[0][column] if rows else None
+        self.next_cursor = rows[-1][column] if rows else None
+        return rows
+
     @classmethod
     def _sanitize(cls, value, default, minimum, maximum) -> int:
         value = IntUtils.to_int(value)
@@ -87,6 +136,14 @@ class Pager:
         return self._query or ''
 
     def dict(self) -> dict:
+        if self.cursor is not None or self.next_cursor is not None:
+            return {
+                'limit': self.limit,
+                'cursor': self.cursor,
+                'direction': self.direction,
+                'next_cursor': self.next_cursor if self.has_next else None,
+                'prev_cursor': self.prev_cursor if self.has_prev else None,
+            }
         if self.page and self.limit:
             return {
                 'page': self.page,
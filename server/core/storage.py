@@ -0,0 +1,192 @@
+import hashlib
+import os
+import uuid
+
+import aiofiles
+
+from core.db import db
+from settings import settings
+
+__all__ = ['storage', 'FileTooLarge']
+
+STORE_UPLOAD = db.query(
+    'uploads.store',
+    '''
+    INSERT INTO public.uploads(sha256, path, size, refs)
+    VALUES ($1, $2, $3, 1)
+    ON CONFLICT (sha256) DO UPDATE SET refs = uploads.refs + 1
+    RETURNING path, size, refs
+    '''
+)
+GET_UPLOAD = db.query(
+    'uploads.get',
+    '''
+    SELECT path, size, refs
+    FROM public.uploads
+    WHERE sha256 = $1
+    '''
+)
+ACQUIRE_UPLOAD = db.query(
+    'uploads.acquire',
+    '''
+    UPDATE public.uploads
+    SET refs = refs + 1
+    WHERE path = $1
+    RETURNING path, size, refs
+    '''
+)
+UPLOAD_SHA256 = db.query(
+    'uploads.sha256',
+    '''
+    SELECT sha256
+    FROM public.uploads
+    WHERE path = $1
+    '''
+)
+LOCK_UPLOAD = db.query(
+    'uploads.lock',
+    '''
+    SELECT pg_advisory_xact_lock(hashtext($1))
+    '''
+)
+RELEASE_UPLOAD = db.query(
+    'uploads.release',
+    '''
+    UPDATE public.uploads
+    SET refs = refs - 1
+    WHERE path = $1
+    RETURNING sha256, refs
+    '''
+)
+DELETE_UPLOAD = db.query(
+    'uploads.delete',
+    '''
+    DELETE
+    FROM public.uploads
+    WHERE sha256 = $1 AND refs <= 0
+    RETURNING path
+    '''
+)
+
+
+class FileTooLarge(Exception):
+    pass
+
+
+class UploadStorage:
+    # Файлы в static/uploads адресуются по sha256 содержимого: {h[:2]}/{h[2:4]}/{h}.{ext}.
+    # Повторная загрузка того же файла не занимает место, а только увеличивает refs в uploads;
+    # файл удаляется, когда освобождена последняя ссылка. Изменение refs и операции с файлом
+    # идут в транзакции под advisory lock по sha256, чтобы release не удалил файл, на который
+    # параллельный store уже сослался
+
+    def __init__(self):
+        self.root = settings.get('file_path', '') + '/static/uploads'
+
+        self.stored = 0
+        self.deduplicated = 0
+
+    @classmethod
+    def name_for(cls, sha256, ext) -> str:
+        return f'{sha256[:2]}/{sha256[2:4]}/{sha256}.{ext}'
+
+    def full_path(self, name) -> str:
+        return f'{self.root}/{name}'
+
+    async def find(self, sha256) -> dict:
+        if not sha256:
+            return {}
+
+        upload = await db.fetchrow(GET_UPLOAD, sha256)
+        if upload and os.path.exists(self.full_path(upload['path'])):
+            return dict(upload)
+        return {}
+
+    async def save(self, name, chunks, max_size=None) -> dict:
+        # Записать поток кусков во временный файл, считая sha256 по ходу, и перенести в хранилище
+        ext = name.split('.')[len(name.split('.')) - 1] if '.' in name else 'bin'
+
+        os.makedirs(f'{self.root}/tmp', 0o755, True)
+        tmp_name = f'{self.root}/tmp/{uuid.uuid4()}.part'
+
+        hasher = hashlib.sha256()
+        size = 0
+        try:
+            async with aiofiles.open(tmp_name, 'wb') as f:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if max_size and size > max_size:
+                        raise FileTooLarge()
+
+                    hasher.update(chunk)
+                    await f.write(chunk)
+
+            upload = await self.store(tmp_name, hasher.hexdigest(), size, ext)
+
+        except BaseException:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            raise
+
+        return {
+            'file_name': upload['path'],
+            'size': size,
+            'sha256': hasher.hexdigest(),
+        }
+
+    async def store(self, tmp_name, sha256, size, ext) -> dict:  # Перенести временный файл в хранилище
+        async with db.connection(transaction=True):
+            await db.execute(LOCK_UPLOAD, sha256)
+
+            # Сначала ссылка: пока она есть, release файл не удалит
+            upload = dict(await db.fetchrow(STORE_UPLOAD, sha256, self.name_for(sha256, ext), size))
+            name = upload['path']
+
+            if os.path.exists(self.full_path(name)):
+                os.remove(tmp_name)
+                self.deduplicated += 1
+            else:
+                os.makedirs(os.path.dirname(self.full_path(name)), 0o755, True)
+                os.replace(tmp_name, self.full_path(name))
+                self.stored += 1
+
+        return upload
+
+    async def acquire(self, name) -> dict:  # Еще одна ссылка на уже загруженный файл; {} - файла уже нет
+        sha256 = await db.fetchval(UPLOAD_SHA256, name)
+        if not sha256:
+            return {}
+
+        async with db.connection(transaction=True):
+            await db.execute(LOCK_UPLOAD, sha256)
+            if not os.path.exists(self.full_path(name)):
+                return {}
+
+            upload = await db.fetchrow(ACQUIRE_UPLOAD, name)
+            return dict(upload) if upload else {}
+
+    async def release(self, name) -> bool:  # Освободить ссылку; True, если файл удален
+        sha256 = await db.fetchval(UPLOAD_SHA256, name)
+        if not sha256:
+            return False
+
+        async with db.connection(transaction=True):
+            await db.execute(LOCK_UPLOAD, sha256)
+            upload = await db.fetchrow(RELEASE_UPLOAD, name)
+            if not upload or upload['refs'] > 0:
+                return False
+
+            path = await db.fetchval(DELETE_UPLOAD, sha256)
+            if path and os.path.exists(self.full_path(path)):
+                os.remove(self.full_path(path))
+
+        return bool(path)
+
+    def stats(self) -> dict:
+        return {
+            'stored': self.stored,
+            'deduplicated': self.deduplicated,
+        }
+
+
+storage = UploadStorage()
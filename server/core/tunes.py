@@ -0,0 +1,136 @@
+import asyncio
+import bisect
+import itertools
+import random
+import time
+
+from core.cache import cache
+from core.db import db
+
+__all__ = ['tunes']
+
+ACTIVE_TUNES = db.query(
+    'tunes.active',
+    '''
+    SELECT *
+    FROM public.tunes
+    WHERE status = 1
+    ORDER BY id
+    '''
+)
+
+
+class TunePicker:
+    # Активные треки в памяти процесса, сгруппированные по жанру: выбор за O(1),
+    # взвешенный выбор за O(log n). Сбрасывается по TTL и сообщению в канал CHANNEL
+    CHANNEL = 'art:tunes:invalidate'
+    PLAYED_PREFIX = 'art:tunes:played'
+    PLAYED_TTL = 60 * 60 * 24 * 7
+    ATTEMPTS = 5
+
+    def __init__(self):
+        self.ttl = 300
+        self.weighted = False
+        self.no_repeat = False
+
+        self.genres = {}
+        self.tunes = {}
+        self.expires_at = 0
+        self.lock = None
+
+        self.picks = 0
+        self.loads = 0
+
+    async def initialize(self, ttl=300, weighted=False, no_repeat=False):
+        self.ttl = ttl
+        self.weighted = weighted
+        self.no_repeat = no_repeat
+        await cache.subscribe(self.CHANNEL, self.reset)
+
+    def reset(self, *_):
+        self.expires_at = 0
+
+    async def invalidate(self):  # Сбросить кэш во всех воркерах
+        self.reset()
+        await cache.publish(self.CHANNEL, '*')
+
+    async def load(self):
+        if self.expires_at > time.monotonic():
+            return
+
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+
+        async with self.lock:
+            if self.expires_at > time.monotonic():
+                return
+
+            items = await db.fetch(ACTIVE_TUNES)
+
+            genres, tunes = {}, {}
+            for item in items:
+                tune = dict(item)
+                tunes[tune['id']] = tune
+                genres.setdefault(tune['genre'], []).append(tune['id'])
+
+            self.genres = {
+                genre: {
+                    'ids': ids,
+                    'cum_weights': list(itertools.accumulate(self.weight(tunes[x]) for x in ids)),
+                }
+                for genre, ids in genres.items()
+            }
+            self.tunes = tunes
+            self.expires_at = time.monotonic() + self.ttl
+            self.loads += 1
+
+    @classmethod
+    def weight(cls, tune):  # Без веса - 1; вес 0 исключает трек из взвешенного выбора
+        weight = tune.get('weight')
+        return 1 if weight is None else max(weight, 0)
+
+    def choice(self, genre):  # None - при взвешенном выборе у всех треков жанра вес 0
+        ids, cum_weights = genre['ids'], genre['cum_weights']
+        if not self.weighted:
+            return random.choice(ids)
+        if cum_weights[-1] <= 0:
+            return None
+        return ids[bisect.bisect_right(cum_weights, random.random() * cum_weights[-1])]
+
+    async def pick(self, genre, customer_id=None) -> dict:
+        await self.load()
+
+        entry = self.genres.get(genre)
+        tune_id = self.choice(entry) if entry else None
+        if tune_id is None:
+            return {}
+
+        self.picks += 1
+        if not self.no_repeat or not customer_id or len(entry['ids']) == 1:
+            return self.tunes[tune_id]
+
+        key = f'{self.PLAYED_PREFIX}:{customer_id}:{genre}'
+        for attempt in range(self.ATTEMPTS):
+            if attempt:
+                tune_id = self.choice(entry)
+            if not await cache.sismember(key, tune_id):
+                break
+        else:
+            await cache.delete(key)  # Все или почти все прослушаны, начинаем заново
+
+        tr = cache.multi_exec()
+        tr.sadd(key, tune_id)
+        tr.expire(key, self.PLAYED_TTL)
+        await tr.execute()
+
+        return self.tunes[tune_id]
+
+    def stats(self) -> dict:
+        return {
+            'genres': {k: len(v['ids']) for k, v in self.genres.items()},
+            'picks': self.picks,
+            'loads': self.loads,
+        }
+
+
+tunes = TunePicker()
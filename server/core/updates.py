@@ -0,0 +1,117 @@
+import asyncio
+import contextlib
+import time
+import uuid
+
+from core.cache import cache
+
+__all__ = ['updates', 'ChatBusy']
+
+UNLOCK_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+'''
+
+
+class ChatBusy(Exception):
+    pass
+
+
+class UpdateIngest:
+    # Прием update от Telegram: повторно присланные update_id отбрасываются, а update одного
+    # чата обрабатываются строго по одному (локальный asyncio.Lock в процессе и lease в Redis
+    # между воркерами). Разные чаты обрабатываются параллельно.
+    # Просмотренные update_id хранятся битами: один bitmap на BUCKET_BITS идентификаторов с TTL
+    PREFIX = 'art:telegram:updates'
+    BUCKET_BITS = 20  # 2^20 update_id на ключ, не больше 128 КБ
+    SEEN_TTL = 60 * 60 * 24
+
+    LOCK_TTL = 60
+    LOCK_WAIT = 30
+
+    def __init__(self):
+        self.locks = {}  # chat_id -> [asyncio.Lock, число ожидающих]
+
+        self.accepted = 0
+        self.duplicates = 0
+        self.lock_waits = 0
+        self.lock_timeouts = 0
+
+    def seen_key(self, update_id, namespace=None):  # namespace - отдельный учет (прогон replay)
+        if namespace:
+            return f'{self.PREFIX}:seen:{namespace}:{update_id >> self.BUCKET_BITS}'
+        return f'{self.PREFIX}:seen:{update_id >> self.BUCKET_BITS}'
+
+    def lock_key(self, chat_id):
+        return f'{self.PREFIX}:lock:{chat_id}'
+
+    async def seen(self, update_id, namespace=None) -> bool:  # Отметить update_id; True, если он уже был
+        key = self.seen_key(update_id, namespace)
+
+        tr = cache.multi_exec()
+        previous = tr.setbit(key, update_id & ((1 << self.BUCKET_BITS) - 1), 1)
+        tr.expire(key, self.SEEN_TTL)
+        await tr.execute()
+
+        if await previous:
+            self.duplicates += 1
+            return True
+
+        self.accepted += 1
+        return False
+
+    async def forget(self, update_id, namespace=None):  # Обработка не удалась: повтор от Telegram должен пройти
+        await cache.setbit(self.seen_key(update_id, namespace), update_id & ((1 << self.BUCKET_BITS) - 1), 0)
+
+    @contextlib.asynccontextmanager
+    async def chat(self, chat_id):
+        entry = self.locks.get(chat_id)
+        if entry is None:
+            entry = self.locks[chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+
+        try:
+            if entry[0].locked():
+                self.lock_waits += 1
+
+            async with entry[0]:
+                token = await self.acquire(chat_id)
+                try:
+                    yield
+                finally:
+                    await cache.eval(UNLOCK_SCRIPT, keys=[self.lock_key(chat_id)], args=[token])
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[chat_id]
+
+    async def acquire(self, chat_id) -> str:
+        token = str(uuid.uuid4())
+        deadline = time.monotonic() + self.LOCK_WAIT
+        delay = 0.05
+
+        while not await cache.set(self.lock_key(chat_id), token, expire=self.LOCK_TTL, exist='SET_IF_NOT_EXIST'):
+            if time.monotonic() > deadline:
+                self.lock_timeouts += 1
+                raise ChatBusy(chat_id)
+
+            if delay == 0.05:
+                self.lock_waits += 1  # чат занят другим воркером
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+        return token
+
+    def stats(self) -> dict:
+        return {
+            'accepted': self.accepted,
+            'duplicates': self.duplicates,
+            'active_chats': len(self.locks),
+            'lock_waits': self.lock_waits,
+            'lock_timeouts': self.lock_timeouts,
+        }
+
+
+updates = UpdateIngest()
@@ -0,0 +1,158 @@
+import asyncio
+import time
+
+import asyncpg
+
+from core.db import db
+
+__all__ = ['writer']
+
+
+class WriteBehind:
+    # Отложенная запись некритичных UPDATE (названия плейлистов, имена клиентов, счетчики кэша
+    # генераций): строки копятся в памяти по запросам и пишутся пачкой через executemany - по
+    # размеру (max_size) или раз в interval секунд. При остановке сервера буфер дописывается.
+    # Запросы с RETURNING (например, playlist.insert) сюда не подходят - им нужен ответ сразу.
+    # Запись может отставать от ответа бота на interval, это видно в stats (lag)
+    MAX_PENDING_FACTOR = 10  # при недоступной БД держим не больше max_size * 10 строк
+
+    def __init__(self):
+        self.buffers = {}  # Query -> [(время постановки, args), ...]
+        self.pending = 0
+        self.max_size = 500
+        self.interval = 1.0
+        self.enabled = False
+        self.wakeup = None
+        self.flusher = None
+
+        self.written = 0
+        self.flushes = 0
+        self.dropped = 0
+        self.errors = 0
+        self.flush_time = 0
+        self.max_lag = 0
+        self.last_lag = 0
+
+    async def initialize(self, max_size=500, interval=1.0, enabled=True):
+        self.max_size = max_size
+        self.interval = interval
+        self.enabled = enabled
+        self.wakeup = asyncio.Event()
+        if enabled:
+            self.flusher = asyncio.ensure_future(self.run())
+
+    async def close(self):
+        self.enabled = False
+        if self.flusher is not None:
+            # Не отменяем flusher посреди executemany: он сам выходит после текущей записи
+            self.wakeup.set()
+            await self.flusher
+            self.flusher = None
+
+        await self.flush()  # все, что накопилось, пишется до закрытия пула БД
+
+    async def write(self, query, *args):
+        _query = db.resolve(query)
+        if not self.enabled or _query is None:  # вне сервера, при enabled=False и для сырого SQL пишем сразу
+            await db.execute(query, *args)
+            return
+
+        self.buffers.setdefault(_query, []).append((time.monotonic(), args))
+        self.pending += 1
+        if self.pending >= self.max_size:
+            self.wakeup.set()
+
+    async def run(self):
+        while self.enabled:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f'[writer] {e}')
+
+    async def flush(self):
+        if not self.pending:
+            return
+
+        buffers, self.buffers, self.pending = self.buffers, {}, 0
+        started = time.monotonic()
+
+        for query, rows in buffers.items():
+            try:
+                await db.executemany(query, [args for _, args in rows])
+            except asyncpg.PostgresError as e:
+                # Пачка откатилась из-за данных: пишем по одной строке, чтобы плохая строка не держала остальные
+                print(f'[writer] {query.name}: {e}')
+                self.errors += 1
+                rows = await self.write_rows(query, rows)
+            except Exception as e:
+                # БД недоступна: пачка вернется в буфер и будет записана следующим flush
+                print(f'[writer] {query.name}: {e}')
+                self.errors += 1
+                self.requeue(query, rows)
+                continue
+
+            if rows:
+                lag = started - rows[0][0]
+                self.last_lag = lag
+                self.max_lag = max(self.max_lag, lag)
+                self.written += len(rows)
+
+        self.flushes += 1
+        self.flush_time += time.monotonic() - started
+
+    async def write_rows(self, query, rows) -> list:  # Записанные строки; ошибочные отбрасываются
+        written = []
+        for i, row in enumerate(rows):
+            try:
+                await db.execute(query, *row[1])
+            except asyncpg.PostgresError as e:
+                print(f'[writer] {query.name} {row[1]}: dropped, {e}')
+                self.dropped += 1
+                continue
+            except Exception as e:
+                print(f'[writer] {query.name}: {e}')
+                self.requeue(query, rows[i:])
+                break
+
+            written.append(row)
+
+        return written
+
+    def requeue(self, query, rows):  # Вернуть пачку в начало буфера, лишнее сверх лимита отбросить
+        current = self.buffers.get(query, [])
+        rows = rows + current
+
+        overflow = self.pending - len(current) + len(rows) - self.max_size * self.MAX_PENDING_FACTOR
+        if overflow > 0:
+            print(f'[writer] {query.name}: dropped {overflow} rows')
+            self.dropped += overflow
+            rows = rows[overflow:]
+
+        self.pending += len(rows) - len(current)
+        self.buffers[query] = rows
+
+    def stats(self) -> dict:
+        oldest = min((x[0][0] for x in self.buffers.values() if x), default=None)
+        return {
+            'enabled': self.enabled,
+            'pending': self.pending,
+            'written': self.written,
+            'flushes': self.flushes,
+            'errors': self.errors,
+            'dropped': self.dropped,
+            'avg_flush_ms': round(self.flush_time * 1000 / self.flushes, 2) if self.flushes else 0,
+            'lag': {
+                'pending_s': round(time.monotonic() - oldest, 3) if oldest is not None else 0,
+                'last_s': round(self.last_lag, 3),
+                'max_s': round(self.max_lag, 3),
+            },
+        }
+
+
+writer = WriteBehind()
@@ -1,10 +1,24 @@
+import os
+
 from sanic import Sanic
 
+from api.core.stats import StatsView
 from api.core.upload import UploadView
+from clients.outbox import outbox
+from core.catalogue import catalogue
+from core.customers import customers
 from core.cache import cache
 from core.db import db
+from core.generation import generation
+from core.httpclient import client
+from core.lemmatizer import lemmatizer
+from core.migrations import migrations
+from core.tunes import tunes
+from core.writer import writer
 from settings import settings
 from webhooks import webhooks_bp
+from webhooks.poller import poller
+from webhooks.telegram import TelegramWebhookHandler
 
 app = Sanic(name='demo')
 
@@ -14,16 +28,136 @@ app.config.DB_DATABASE = settings.get('db', {}).get('database', 'maindb')
 app.config.DB_PORT = settings.get('db', {}).get('port', 5432)
 app.config.DB_USER = settings.get('db', {}).get('user', 'postgres')
 app.config.DB_PASSWORD = settings.get('db', {}).get('password', '1234')
-app.config.DB_POOL_MAX_SIZE = 25
+app.config.DB_POOL_MIN_SIZE = settings.get('db', {}).get('pool_min_size', 2)
+app.config.DB_POOL_MAX_SIZE = settings.get('db', {}).get('pool_max_size', 25)
+app.config.DB_POOL_ADAPTIVE = settings.get('db', {}).get('pool_adaptive', False)
+app.config.REDIS_POOL_MIN_SIZE = settings.get('cache', {}).get('pool_min_size', 1)
+app.config.REDIS_POOL_MAX_SIZE = settings.get('cache', {}).get('pool_max_size', 20)
+app.config.REDIS_EXTRA_POOL_MAX_SIZE = settings.get('cache', {}).get('extra_pool_max_size', 2)
+app.config.DB_WRITE_BEHIND = settings.get('db', {}).get('write_behind', True)
+app.config.DB_WRITE_BATCH_SIZE = settings.get('db', {}).get('write_batch_size', 500)
+app.config.DB_WRITE_INTERVAL = settings.get('db', {}).get('write_interval', 1.0)
+app.config.DB_MIGRATE = settings.get('db', {}).get('migrate', False)
+app.config.HTTP_POOL_LIMIT = settings.get('http', {}).get('limit', 100)
+app.config.HTTP_POOL_LIMIT_PER_HOST = settings.get('http', {}).get('limit_per_host', 30)
+app.config.HTTP_DNS_CACHE_TTL = settings.get('http', {}).get('ttl_dns_cache', 300)
+app.config.HTTP_KEEPALIVE_TIMEOUT = settings.get('http', {}).get('keepalive_timeout', 60)
+app.config.TG_OUTBOX_BACKEND = settings.get('tg', {}).get('outbox', 'redis')
+app.config.TG_OUTBOX_WORKERS = settings.get('tg', {}).get('outbox_workers', 4)
+app.config.TG_MODE = settings.get('tg', {}).get('mode', 'webhook')
+app.config.TG_POLL_CONCURRENCY = settings.get('tg', {}).get('poll_concurrency', 8)
+app.config.TG_POLL_TIMEOUT = settings.get('tg', {}).get('poll_timeout', 25)
+app.config.TG_POLL_LIMIT = settings.get('tg', {}).get('poll_limit', 100)
+app.config.TG_REPLAY_FILE = settings.get('tg', {}).get('replay_file')
+app.config.MYSTEM_WORKERS = settings.get('mystem', {}).get('workers', 2)
+app.config.MYSTEM_QUEUE_SIZE = settings.get('mystem', {}).get('queue_size', 100)
+app.config.MYSTEM_TIMEOUT = settings.get('mystem', {}).get('timeout', 5)
+app.config.MYSTEM_BATCH_SIZE = settings.get('mystem', {}).get('batch_size', 32)
+app.config.MYSTEM_CACHE_SIZE = settings.get('mystem', {}).get('cache_size', 10000)
+app.config.MYSTEM_CACHE_SHARE = settings.get('mystem', {}).get('cache_share', False)
+app.config.CATALOGUE_TTL = settings.get('catalogue', {}).get('ttl', 300)
+app.config.CUSTOMERS_CACHE_SIZE = settings.get('customers', {}).get('cache_size', 10000)
+app.config.TUNES_TTL = settings.get('tunes', {}).get('ttl', 300)
+app.config.TUNES_WEIGHTED = settings.get('tunes', {}).get('weighted', False)
+app.config.TUNES_NO_REPEAT = settings.get('tunes', {}).get('no_repeat', False)
+app.config.GENERATION_BACKEND = settings.get('generation', {}).get('backend', 'stub')
+app.config.GENERATION_WORKERS = settings.get('generation', {}).get('workers', 2)
+app.config.GENERATION_TIMEOUT = settings.get('generation', {}).get('timeout', 300)
+app.config.GENERATION_MAX_ATTEMPTS = settings.get('generation', {}).get('max_attempts', 3)
+app.config.GENERATION_PERSIST = settings.get('generation', {}).get('persist', True)
+app.config.GENERATION_CACHE_MAX_ENTRIES = settings.get('generation', {}).get('cache_max_entries', 1000)
+app.config.GENERATION_CACHE_MAX_AGE = settings.get('generation', {}).get('cache_max_age', 60 * 60 * 24 * 30)
+app.config.GENERATION_OPTIONS = settings.get('generation', {}).get(app.config.GENERATION_BACKEND, {})
 app.config.RESPONSE_TIMEOUT = 600
 app.config.FALLBACK_ERROR_FORMAT = 'html'
-app.config.DEBUG = True
+app.config.SERVER_HOST = settings.get('server', {}).get('host', '127.0.0.1')
+app.config.SERVER_PORT = settings.get('server', {}).get('port', 8109)
+app.config.SERVER_WORKERS = settings.get('server', {}).get('workers', 1) or os.cpu_count()
+app.config.SERVER_ACCESS_LOG = settings.get('server', {}).get('access_log', False)
+app.config.DEBUG = settings.get('server', {}).get('debug', False)
+# Сколько ждать незавершенные запросы при остановке воркера
+app.config.GRACEFUL_SHUTDOWN_TIMEOUT = settings.get('server', {}).get('graceful_shutdown_timeout', 15)
 
 
 @app.listener('before_server_start')
 async def initialize_modules(_app, _loop):
-    await db.initialize(_app, _loop)
-    await cache.initialize(_loop, maxsize=5)
+    await db.initialize(
+        _app,
+        _loop,
+        min_size=_app.config.DB_POOL_MIN_SIZE,
+        max_size=_app.config.DB_POOL_MAX_SIZE,
+        adaptive=_app.config.DB_POOL_ADAPTIVE
+    )
+    await migrations.check(migrate=_app.config.DB_MIGRATE)
+    await writer.initialize(
+        max_size=_app.config.DB_WRITE_BATCH_SIZE,
+        interval=_app.config.DB_WRITE_INTERVAL,
+        enabled=_app.config.DB_WRITE_BEHIND
+    )
+    await cache.initialize(
+        _loop,
+        minsize=_app.config.REDIS_POOL_MIN_SIZE,
+        maxsize=_app.config.REDIS_POOL_MAX_SIZE,
+        extra_maxsize=_app.config.REDIS_EXTRA_POOL_MAX_SIZE
+    )
+    await client.initialize(
+        limit=_app.config.HTTP_POOL_LIMIT,
+        limit_per_host=_app.config.HTTP_POOL_LIMIT_PER_HOST,
+        ttl_dns_cache=_app.config.HTTP_DNS_CACHE_TTL,
+        keepalive_timeout=_app.config.HTTP_KEEPALIVE_TIMEOUT
+    )
+    await outbox.initialize(backend=_app.config.TG_OUTBOX_BACKEND, workers=_app.config.TG_OUTBOX_WORKERS)
+    await lemmatizer.initialize(
+        workers=_app.config.MYSTEM_WORKERS,
+        queue_size=_app.config.MYSTEM_QUEUE_SIZE,
+        timeout=_app.config.MYSTEM_TIMEOUT,
+        batch_size=_app.config.MYSTEM_BATCH_SIZE,
+        cache_size=_app.config.MYSTEM_CACHE_SIZE,
+        share=_app.config.MYSTEM_CACHE_SHARE
+    )
+    await catalogue.initialize(ttl=_app.config.CATALOGUE_TTL)
+    await customers.initialize(maxsize=_app.config.CUSTOMERS_CACHE_SIZE)
+    await tunes.initialize(
+        ttl=_app.config.TUNES_TTL,
+        weighted=_app.config.TUNES_WEIGHTED,
+        no_repeat=_app.config.TUNES_NO_REPEAT
+    )
+    await generation.initialize(
+        backend=_app.config.GENERATION_BACKEND,
+        workers=_app.config.GENERATION_WORKERS,
+        timeout=_app.config.GENERATION_TIMEOUT,
+        max_attempts=_app.config.GENERATION_MAX_ATTEMPTS,
+        persist=_app.config.GENERATION_PERSIST,
+        cache_max_entries=_app.config.GENERATION_CACHE_MAX_ENTRIES,
+        cache_max_age=_app.config.GENERATION_CACHE_MAX_AGE,
+        notify=TelegramWebhookHandler.send_track,
+        **_app.config.GENERATION_OPTIONS
+    )
+    await TelegramWebhookHandler.warmup()
+    if _app.config.TG_MODE != 'webhook':
+        await poller.initialize(
+            mode=_app.config.TG_MODE,
+            concurrency=_app.config.TG_POLL_CONCURRENCY,
+            timeout=_app.config.TG_POLL_TIMEOUT,
+            limit=_app.config.TG_POLL_LIMIT,
+            replay_file=_app.config.TG_REPLAY_FILE
+        )
+
+
+@app.listener('before_server_stop')
+async def drain_modules(_app, _loop):
+    await poller.close()
+    await generation.close()
+    await writer.close()
+    await outbox.close()
+
+
+@app.listener('after_server_stop')
+async def finalize_modules(_app, _loop):
+    await client.close()
+    await lemmatizer.close()
+    await db.close()
+    await cache.close()
 
 
 app.blueprint([
@@ -31,9 +165,17 @@ app.blueprint([
 ])
 
 app.add_route(UploadView.as_view(), '/api/upload/')
+app.add_route(StatsView.as_view(), '/api/stats/')
 
 if __name__ == '__main__':
     try:
-        app.run('127.0.0.1', port=8109, access_log=True)
+        # Каждый воркер - отдельный процесс на общем порту со своими пулами БД/Redis и Mystem
+        app.run(
+            app.config.SERVER_HOST,
+            port=app.config.SERVER_PORT,
+            workers=app.config.SERVER_WORKERS,
+            debug=app.config.DEBUG,
+            access_log=app.config.SERVER_ACCESS_LOG
+        )
     except Exception as e:
         print(e)
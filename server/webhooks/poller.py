@@ -0,0 +1,282 @@
+import asyncio
+import sys
+import time
+import uuid
+
+import aiofiles
+import ujson
+from aiohttp import web
+
+from clients.telegram import tgclient
+from core.cache import cache
+from utils.ints import IntUtils
+from webhooks.telegram import TelegramWebhookHandler
+
+__all__ = ['poller']
+
+RENEW_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+'''
+RELEASE_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+'''
+
+
+class TelegramPoller:
+    # Прием update через getUpdates вместо webhook (tg.mode = polling) и прогон записанных update
+    # из файла (tg.mode = replay). Update обрабатываются тем же TelegramWebhookHandler.handle:
+    # дедупликация по update_id и очередность внутри чата те же, что у webhook.
+    # Опрашивает Telegram один воркер - владелец lease в Redis; offset тоже в Redis, чтобы
+    # после смены владельца продолжить с того же места. Update одного чата из пачки идут
+    # по порядку, разные чаты - параллельно, не больше concurrency одновременно
+    PREFIX = 'art:telegram:poller'
+    LEASE_TTL = 90  # больше timeout опроса и времени на обработку пачки
+    IDLE_DELAY = 5  # как часто воркер без lease проверяет, не освободился ли он
+    MAX_ATTEMPTS = 3  # повторы update, если чат занят (ChatBusy)
+
+    def __init__(self):
+        self.handler = None
+        self.semaphore = None
+        self.task = None
+        self.token = None
+        self.mode = None
+
+        self.concurrency = 8
+        self.timeout = 25
+        self.limit = 100
+        self.offset = None
+        self.namespace = None  # учет update_id для replay, свой у каждого прогона
+
+        self.polls = 0
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+        self.busy = 0
+        self.errors = 0
+        self.active = 0
+        self.handle_time = 0
+
+    @property
+    def lease_key(self):
+        return f'{self.PREFIX}:lease'
+
+    @property
+    def offset_key(self):
+        return f'{self.PREFIX}:offset'
+
+    async def initialize(self, mode='polling', concurrency=8, timeout=25, limit=100, replay_file=None):
+        self.handler = TelegramWebhookHandler()
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.mode = mode
+        self.concurrency = concurrency
+        self.timeout = min(timeout, self.LEASE_TTL - 30)
+        self.limit = limit
+
+        if mode == 'polling':
+            self.task = asyncio.ensure_future(self.run())
+        elif mode == 'replay':
+            self.task = asyncio.ensure_future(self.replay(replay_file))
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                print(f'[poller] {e}')
+            self.task = None
+
+        if self.token is not None:
+            await cache.eval(RELEASE_SCRIPT, keys=[self.lease_key], args=[self.token])
+            self.token = None
+
+    async def lead(self) -> bool:  # Взять или продлить lease опроса
+        if self.token is not None:
+            if await cache.eval(RENEW_SCRIPT, keys=[self.lease_key], args=[self.token, self.LEASE_TTL]):
+                return True
+            print('[poller] lease lost')
+            self.token = None
+            self.offset = None
+
+        token = str(uuid.uuid4())
+        if not await cache.set(self.lease_key, token, expire=self.LEASE_TTL, exist='SET_IF_NOT_EXIST'):
+            return False
+
+        self.token = token
+        self.offset = IntUtils.to_int(await cache.get(self.offset_key))
+
+        if self.mode == 'polling':  # getUpdates не работает, пока у бота установлен webhook
+            result = await tgclient.api_call(method_name='deleteWebhook', payload={'drop_pending_updates': False})
+            if not result.get('ok'):
+                print(f'[poller] deleteWebhook: {result}')
+
+        return True
+
+    async def run(self):
+        while True:
+            try:
+                if not await self.lead():
+                    await asyncio.sleep(self.IDLE_DELAY)
+                    continue
+
+                batch = await self.poll()
+                if batch:
+                    await self.process(batch)
+
+                    # Следующий getUpdates с этим offset подтверждает пачку в Telegram
+                    self.offset = max(IntUtils.to_int(x.get('update_id'), default=0) for x in batch) + 1
+                    await cache.set(self.offset_key, self.offset)
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f'[poller] {e}')
+                self.errors += 1
+                await asyncio.sleep(1)
+
+    async def poll(self) -> list:
+        payload = {
+            'timeout': self.timeout,
+            'limit': self.limit,
+            'allowed_updates': ['message', 'callback_query'],
+        }
+        if self.offset is not None:
+            payload['offset'] = self.offset
+
+        self.polls += 1
+        result = await tgclient.api_call(method_name='getUpdates', payload=payload, timeout=self.timeout + 10)
+        if not result.get('ok'):
+            print(f'[poller] getUpdates: {result}')
+            self.errors += 1
+            await asyncio.sleep(1)
+            return []
+
+        batch = [x for x in result.get('result') or [] if isinstance(x, dict)]
+        self.received += len(batch)
+        return batch
+
+    async def process(self, batch):
+        chats = {}
+        for update in batch:
+            chat_id = self.handler.parse(update)[0]
+            chats.setdefault(chat_id, []).append(update)
+
+        await asyncio.gather(*[self.process_chat(x) for x in chats.values()])
+
+    async def process_chat(self, batch):
+        async with self.semaphore:
+            self.active += 1
+            try:
+                for update in batch:
+                    await self.handle(update)
+            finally:
+                self.active -= 1
+
+    async def handle(self, update):
+        started = time.monotonic()
+        try:
+            for attempt in range(self.MAX_ATTEMPTS):
+                if await self.handler.handle(update, self.namespace) != 503:
+                    self.processed += 1
+                    return
+
+                self.busy += 1  # чат держит другой воркер (webhook), update уже забыт в updates.forget
+                await asyncio.sleep(attempt + 1)
+
+            self.failed += 1
+            print(f'[poller] chat busy, update {update.get("update_id")} dropped')
+
+        except Exception as e:
+            self.failed += 1
+            print(f'[poller] update {update.get("update_id")}: {e}')
+
+        finally:
+            self.handle_time += time.monotonic() - started
+
+    async def replay(self, path):
+        # Прогон записанных update (JSON lines: update или ответ getUpdates) через тот же путь,
+        # что и getUpdates. Дедупликация у каждого прогона своя: повторы внутри файла отбрасываются,
+        # а повторный прогон того же файла обрабатывается заново
+        while not await self.lead():
+            await asyncio.sleep(self.IDLE_DELAY)
+
+        self.namespace = f'replay:{uuid.uuid4().hex}'
+
+        count = 0
+        started = time.monotonic()
+        batch = []
+        async with aiofiles.open(path, 'r') as f:
+            async for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+
+                data = ujson.loads(line)
+                for update in (data.get('result') or []) if 'result' in data else [data]:
+                    batch.append(update)
+                    if len(batch) >= self.limit:
+                        await self.process(batch)
+                        count += len(batch)
+                        batch = []
+                        await self.lead()
+
+        if batch:
+            await self.process(batch)
+            count += len(batch)
+
+        elapsed = time.monotonic() - started
+        self.received += count
+        print(f'[poller] replayed {count} updates from {path} in {elapsed:.1f}s ({count / max(elapsed, 0.001):.1f}/s)')
+
+    def stats(self) -> dict:
+        handled = self.processed + self.failed
+        return {
+            'mode': self.mode,
+            'leader': self.token is not None,
+            'offset': self.offset,
+            'concurrency': self.concurrency,
+            'active': self.active,
+            'polls': self.polls,
+            'received': self.received,
+            'processed': self.processed,
+            'failed': self.failed,
+            'busy': self.busy,
+            'errors': self.errors,
+            'avg_handle_time': round(self.handle_time / handled, 4) if handled else 0,
+        }
+
+
+poller = TelegramPoller()
+
+
+def stub(port=8081, delay=0.05):
+    # Заглушка Bot API для нагрузочных тестов (tg.api_url = 'http://127.0.0.1:8081'):
+    # на любой метод отвечает ok через delay секунд, getUpdates - пустой пачкой
+    async def handle(request):
+        method = request.match_info['method']
+        if method == 'getUpdates':
+            await asyncio.sleep(1)
+            return web.json_response({'ok': True, 'result': []})
+
+        await asyncio.sleep(delay)
+        return web.json_response({'ok': True, 'result': {'message_id': 1, 'date': int(time.time())}})
+
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', handle)
+    web.run_app(app, host='127.0.0.1', port=port)
+
+
+if __name__ == '__main__':
+    # python -m webhooks.poller stub [port]
+    if sys.argv[1:2] == ['stub']:
+        stub(port=IntUtils.to_int(sys.argv[2] if len(sys.argv) > 2 else None, default=8081))
+    else:
+        print('usage: python -m webhooks.poller stub [port]')
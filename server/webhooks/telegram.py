@@ -1,14 +1,18 @@
-import asyncio
-import random
-
-import ujson
-from pymystem3 import Mystem
 from sanic import response
 from sanic.views import HTTPMethodView
 
-from clients.telegram import tgclient
-from core.cache import cache
+from clients.outbox import outbox
+from core.catalogue import catalogue
+from core.conversation import Conversation
+from core.customers import customers
 from core.db import db
+from core.generation import generation, READY
+from core.lemmatizer import lemmatizer
+from core.matcher import PhraseMatcher
+from core.pager import Pager
+from core.tunes import tunes
+from core.updates import ChatBusy, updates
+from core.writer import writer
 from settings import settings
 from utils.dicts import DictUtils
 from utils.ints import IntUtils
@@ -24,6 +28,58 @@ RISK_WORDS = [
     ['нет', 'смысл'], ['нет', 'цель'], ['мучиться'], ['недостойный'], ['виноватый'], ['тяжело'], ['невыносимый']
 ]
 
+risk_matcher = PhraseMatcher(RISK_WORDS)
+
+GET_PLAYLIST = db.query(
+    'playlist.get',
+    '''
+    SELECT *
+    FROM public.playlist
+    WHERE id = $1
+    '''
+)
+SAVED_PLAYLISTS = '''
+    SELECT id, title
+    FROM public.playlist
+    WHERE customer_id = $1 AND status = 3 AND url IS NOT NULL {condition}
+    {order}
+'''
+RENAME_PLAYLIST = db.query(
+    'playlist.rename',
+    '''
+    UPDATE public.playlist
+    SET status = 3, title = $2
+    WHERE id = $1
+    '''
+)
+RENAME_CUSTOMER = db.query(
+    'customers.rename',
+    '''
+    UPDATE public.customers
+    SET name = $2
+    WHERE id = $1
+    '''
+)
+KBASE_REFERENCES = db.query(
+    'kbase.references',
+    '''
+    WITH a AS (SELECT title
+               FROM public.kbase
+               WHERE type = 'reference'
+               ORDER BY id)
+    SELECT array_agg(title)
+    FROM a
+    '''
+)
+KBASE_BY_TITLE = db.query(
+    'kbase.by_title',
+    '''
+    SELECT *
+    FROM public.kbase
+    WHERE title = $1
+    '''
+)
+
 LOCALE_TUNES = [
     {'text': 'Классика', 'callback_data': 'classic'}, {'text': 'Джаз', 'callback_data': 'djazz'},
     {'text': 'Электронная музыка', 'callback_data': 'electronic'},
@@ -31,8 +87,6 @@ LOCALE_TUNES = [
     {'text': 'Звуки природы', 'callback_data': 'nature'}
 ]
 
-m = Mystem()
-
 HOME_BUTTON = [{
     'text': '🏠 Вернуться в меню',
 }]  # Кнопка назад
@@ -57,9 +111,63 @@ MENU_BUTTONS = [
 
 
 class TelegramWebhookHandler(HTTPMethodView):
+    # Кнопки меню действуют в любом состоянии, ключ - первый символ текста кнопки
+    BUTTONS = {
+        '🏠': 'on_home',
+        '🎼': 'on_music',
+        '🛠': 'on_ai_questions',
+        '💬': 'on_search_questions',
+        '📁': 'on_playlists',
+        '\u2069': 'on_audio_name',
+        '🔎': 'on_generate',
+        '📃': 'on_reference',
+        'ℹ': 'on_about',
+    }
+
+    # Обработчик произвольного текста по текущему состоянию диалога
+    STATES = {
+        'name': 'on_name',
+        'audio_name': 'on_audio_title',
+        'rating': 'on_rating',
+        'locale_tune': 'on_locale_tune',
+        'questions': 'on_answer',
+    }
+
+    CALLBACKS = {
+        'playlist': 'on_playlist',
+    }
+
+    @classmethod
+    async def warmup(cls):  # Прогрев кэша лемм текстами кнопок
+        buttons = await db.fetch(
+            '''
+            SELECT unnest(buttons) AS button
+            FROM public.questions
+            '''
+        )
+        texts = [x['button'].get('text') for x in buttons if x['button']] + [x['text'] for x in LOCALE_TUNES]
+        await lemmatizer.warmup(texts)
+
+        await cls.load_risk_words()
 
     @classmethod
-    async def send_rating(cls, customer_id, chat_id, text):
+    async def load_risk_words(cls):  # Словарь риска: встроенный список и фразы из БД
+        phrases = list(RISK_WORDS)
+        for x in await db.fetch(
+            '''
+            SELECT phrase, lemmas
+            FROM public.risk_words
+            WHERE status = 1
+            '''
+        ):
+            lemmas = x['lemmas'] or await lemmatizer.lemmatize(x['phrase'])
+            phrases.append([y for y in ListUtils.to_list_of_strs(lemmas) or [] if y.isalpha()])
+
+        risk_matcher.load(phrases)
+        return len(risk_matcher)
+
+    @classmethod
+    async def send_rating(cls, state, chat_id, text):
         success, genre = False, None
         for x in LOCALE_TUNES:
             if x.get('text') == text:
@@ -67,10 +175,11 @@ class TelegramWebhookHandler(HTTPMethodView):
                 genre = x['callback_data']
 
         if not success:
-            await cls.send_locale_tune(customer_id, chat_id)
+            await cls.send_locale_tune(state, chat_id)
             return
 
-        await cache.setex(f'art:telegram:questions:rating:{customer_id}', 600, '1')
+        state.transition('rating')
+        state.set('genre', genre)  # жанр генерации (generate_turn), сбрасывается в finalize
         wait_payloads = [{
             'method_name': 'sendMessage',
             'payload': {
@@ -79,15 +188,7 @@ class TelegramWebhookHandler(HTTPMethodView):
             }
         }]
 
-        tune = await db.fetchrow(
-            '''
-            SELECT *
-            FROM public.tunes
-            WHERE genre = $1
-            ORDER BY random()
-            ''',
-            genre
-        )
+        tune = await tunes.pick(genre, customer_id=state.customer_id)
 
         if tune:
             wait_payloads.append({
@@ -112,13 +213,11 @@ class TelegramWebhookHandler(HTTPMethodView):
             })
 
         for x in wait_payloads:
-            await tgclient.api_call(method_name=x['method_name'], payload=x['payload'])
-
-        return cls.finalize(customer_id)
+            await outbox.send(method_name=x['method_name'], payload=x['payload'])
 
     @classmethod
-    async def send_locale_tune(cls, customer_id, chat_id):
-        await tgclient.api_call(
+    async def send_locale_tune(cls, state, chat_id):
+        await outbox.send(
             payload={
                 'chat_id': chat_id,
                 'text': 'Вот несколько вариантов музыки, которая может тебе помочь расслабиться:',
@@ -130,81 +229,60 @@ class TelegramWebhookHandler(HTTPMethodView):
             }
         )
 
-        return await cache.setex(f'art:telegram:locale_tune:{customer_id}', 600, 1)
+        state.transition('locale_tune')
 
     @classmethod
-    async def generate_questions(cls, customer_id, _type):  # Генерация вопросов для общения и создания треков
-        items = await db.fetch(
-            '''
-            SELECT c.id, count(*) AS count_questions, array_agg(q.id) AS question_ids, c.attempt
-            FROM public.questions q
-            LEFT JOIN public.categories c on c.id = q.category_id
-            WHERE c.type = $1
-            GROUP BY c.id
-            ''',
-            _type
-        )
-        question_ids = []
-        for item in items:
-            if item.get('count_questions') > item.get('attempt'):
-                question_ids.extend(random.sample(item['question_ids'], item.get('attempt')) or [])
-            else:
-                question_ids.extend(item['question_ids'])
+    async def generate_questions(cls, state, _type):  # Генерация вопросов для общения и создания треков
+        questions = await catalogue.sample(_type)
 
-        questions = ListUtils.to_list_of_dicts(await db.fetch(
-            '''
-            SELECT *
-            FROM public.questions
-            WHERE id = ANY($1)
-            ORDER BY position, random()
-            ''',
-            question_ids
-        )) or []
-
-        await cache.setex(f'art:telegram:questions:{customer_id}', 600, ujson.dumps(questions))
+        # В сессии только id вопросов и курсор, тексты берутся из каталога
+        state.set('questions_type', _type)
+        state.set('queue', [x['id'] for x in questions])
+        state.set('cursor', 0)
 
         return questions
 
     @classmethod
-    async def finalize(cls, customer_id):  # Завершить диалог
-        keys = [
-            f'art:telegram:questions:{customer_id}',
-            f'art:question:name:{customer_id}',
-            f'art:telegram:prev_question:{customer_id}',
-            f'art:telegram:words:{customer_id}',
-            f'art:telegram:audio:name:{customer_id}',
-            f'art:telegram:questions:rating:{customer_id}',
-            f'art:telegram:risk:{customer_id}',
-            f'art:telegram:locale_tune:{customer_id}'
-        ]
-        return await cache.delete(*keys)
+    async def next_question(cls, state) -> dict:
+        queue, cursor = state.get('queue') or [], state.get('cursor') or 0
+        while cursor < len(queue):
+            question = await catalogue.question(state.get('questions_type'), queue[cursor])
+            cursor += 1
+            if question:
+                state.set('cursor', cursor)
+                return question
+
+        state.set('cursor', cursor)
+        return {}
 
     @classmethod
-    async def generate_turn(cls, customer_id, chat_id):  # Генерация треков
-        words = await cache.lrange(f'art:telegram:words:{customer_id}', 0, -1)
-        if words:
-            await tgclient.api_call(
-                method_name='sendMessage',
-                payload={
-                    'chat_id': chat_id,
-                    'text': '⏱️ идет генерация трека ...'
-                }
-            )
+    async def prev_question(cls, state) -> dict:
+        if state.get('prev_question'):
+            return await catalogue.question(state.get('questions_type'), state.get('prev_question')) or {}
+        return {}
 
-            await db.fetchrow(
-                '''
-                INSERT INTO public.playlist(customer_id, words)
-                VALUES ($1, $2)
-                RETURNING *
-                ''',
-                customer_id,
-                list(set(words))
-            )
+    @classmethod
+    def finalize(cls, state):  # Завершить диалог
+        state.clear()
 
-            await asyncio.sleep(5)
+    @classmethod
+    async def generate_turn(cls, state, chat_id):  # Генерация треков
+        words = state.get('words')
+        if words:
+            # Генерация идет в фоне (core.generation), готовый трек придет через send_track;
+            # для уже сгенерированного набора слов трек отправляется сразу
+            playlist = await generation.submit(state.customer_id, chat_id, words, genre=state.get('genre'))
+            if playlist['status'] < READY:  # готовый или неудавшийся трек уже отправлен через send_track
+                await outbox.send(
+                    method_name='sendMessage',
+                    payload={
+                        'chat_id': chat_id,
+                        'text': '⏱️ идет генерация трека ...'
+                    }
+                )
 
         else:
-            await tgclient.api_call(
+            await outbox.send(
                 method_name='sendMessage',
                 payload={
                     'chat_id': chat_id,
@@ -221,16 +299,42 @@ class TelegramWebhookHandler(HTTPMethodView):
         return
 
     @classmethod
-    async def get_playlist(cls, chat_id, _id):  # Отправка трека из списка плейлист
-        playlist = await db.fetchrow(
-            '''
-            SELECT *
-            FROM public.playlist
-            WHERE id = $1
-            ''',
-            int(_id)
+    async def send_track(cls, playlist):  # Результат генерации: трек с кнопкой сохранения или ошибка
+        if playlist['status'] != READY:
+            return await outbox.send(
+                method_name='sendMessage',
+                payload={
+                    'chat_id': playlist['chat_id'],
+                    'text': 'Не удалось сгенерировать трек, попробуйте еще раз',
+                    'reply_markup': {
+                        'keyboard': MENU_BUTTONS,
+                        'one_time_keyboard': True,
+                        'resize_keyboard': True
+                    }
+                }
+            )
+
+        state = await Conversation.load(playlist['customer_id'])
+        state.set('audio', playlist['id'])
+        await state.save()
+
+        await outbox.send(
+            method_name='sendAudio',
+            payload={
+                'chat_id': playlist['chat_id'],
+                'audio': playlist['url'],
+                'reply_markup': {
+                    'keyboard': [[{'text': '\u2069💾 Сохранить в плейлист'}], HOME_BUTTON],
+                    'one_time_keyboard': True,
+                    'resize_keyboard': True
+                }
+            }
         )
-        await tgclient.api_call(
+
+    @classmethod
+    async def get_playlist(cls, chat_id, _id):  # Отправка трека из списка плейлист
+        playlist = await db.fetchrow(GET_PLAYLIST, int(_id))
+        await outbox.send(
             method_name='sendAudio',
             payload={
                 'chat_id': chat_id,
@@ -244,25 +348,21 @@ class TelegramWebhookHandler(HTTPMethodView):
         )
 
     @classmethod
-    async def playlists(cls, customer_id, chat_id, page=1):  # Список плейлист с пагинацией
-        page = int(page)
-        limit = 5
-        offset = (page - 1) * limit
+    async def playlists(cls, customer_id, chat_id, direction='after', cursor=None):  # Список плейлист с пагинацией
+        pager = Pager().set_limit(5).set_cursor(cursor, direction)
 
         buttons = []
 
-        playlists = await db.fetch(
-            '''
-            SELECT *
-            FROM public.playlist
-            WHERE customer_id = $1 AND status = 3 AND url IS NOT NULL
-            ORDER BY id desc
-            LIMIT $2 OFFSET $3
-            ''',
-            customer_id,
-            limit,
-            offset
-        ) or []
+        # Текст запроса зависит только от направления: по одному подготовленному запросу на вариант
+        query = db.query(
+            f'playlist.saved.{pager.direction if pager.cursor is not None else "first"}',
+            SAVED_PLAYLISTS.format(
+                condition=pager.as_keyset_condition(param='$2'),
+                order=pager.as_keyset_query()
+            )
+        )
+        args = [customer_id] if pager.cursor is None else [customer_id, pager.cursor]
+        playlists = pager.set_rows(await db.fetch(query, *args))
 
         for x in playlists:
             buttons.append([
@@ -272,35 +372,23 @@ class TelegramWebhookHandler(HTTPMethodView):
                 }
             ])
 
-        total = await db.fetchval(
-            '''
-            SELECT count(*)
-            FROM public.playlist
-            WHERE customer_id = $1 AND status = 3 AND url IS NOT NULL
-            ''',
-            customer_id
-        ) or 0
-
-        next_page = total > (limit * page)
-        prev_page = page > 1
-
-        if next_page or prev_page:
+        if pager.has_next or pager.has_prev:
             a = []
-            if prev_page:
+            if pager.has_prev:
                 a.append({
                     'text': f'⏮️',
-                    'callback_data': f'playlist:page:{page - 1}'
+                    'callback_data': f'playlist:before:{pager.prev_cursor}'
                 })
-            if next_page:
+            if pager.has_next:
                 a.append({
                     'text': f'⏭️',
-                    'callback_data': f'playlist:page:{page + 1}'
+                    'callback_data': f'playlist:after:{pager.next_cursor}'
                 })
 
             buttons.append(a)
 
         if buttons:
-            await tgclient.api_call(
+            await outbox.send(
                 method_name='sendMessage',
                 payload={
                     'chat_id': chat_id,
@@ -317,113 +405,235 @@ class TelegramWebhookHandler(HTTPMethodView):
         return response.json({})
 
     async def post(self, request):
-        data = request.json
+        status = await self.handle(request.json)
+        return response.json({}, status=status)
 
+    async def handle(self, data, namespace=None) -> int:
+        # Обработка одного update; общая для webhook и long polling (webhooks.poller). Возвращает HTTP-статус.
+        # namespace - отдельный учет обработанных update_id (replay)
         print(f'[post] data: {data}')
 
+        chat_id, sender, message, callback_query = self.parse(data)
+        if not chat_id:
+            return 200
+
+        # Telegram повторяет update, если ответ задержался или был с ошибкой
+        update_id = IntUtils.to_int(data.get('update_id'))
+        if update_id is not None and await updates.seen(update_id, namespace):
+            return 200
+
+        try:
+            async with updates.chat(chat_id):  # update одного чата - строго по очереди
+                async with db.connection():  # одно соединение из пула на весь update
+                    customer = await customers.get(chat_id, sender)
+
+                    state = await Conversation.load(customer['id'])
+                    try:
+                        await self.dispatch(chat_id, customer, state, message, callback_query)
+                    finally:
+                        await state.save()
+
+        except BaseException as e:
+            if update_id is not None:
+                await updates.forget(update_id, namespace)
+            if isinstance(e, ChatBusy):
+                return 503
+            raise
+
+        return 200
+
+    @classmethod
+    def parse(cls, data):  # (chat_id, sender, message, callback_query); chat_id None - update не для бота
         message = DictUtils.as_dict(data.get('message'))
         callback_query = DictUtils.as_dict(data.get('callback_query'))
 
         if message:
             chat_id = StrUtils.to_str(message.get('chat', {}).get('id'))  # чат id пользователя
             sender = message.get('from', {})  # информация о пользователе
-            customer = await db.fetchrow(
-                '''
-                SELECT id, username
-                FROM public.customers
-                WHERE uid = $1
-                ''',
-                chat_id
-            )
         elif callback_query:
             chat_id = StrUtils.to_str(callback_query.get('message', {}).get('chat', {}).get('id'))
             sender = callback_query.get('from', {})
-            customer = await db.fetchrow(
-                '''
-                SELECT id, username
-                FROM public.customers
-                WHERE uid = $1
-                ''',
-                chat_id
-            )
         else:
-            return response.json({})
-
-        if not customer:
-            customer = await db.fetchrow(
-                '''
-                INSERT INTO public.customers(name, username, uid)
-                VALUES ($1, $2, $3)
-                ON CONFLICT DO NOTHING
-                RETURNING id, username
-                ''',
-                sender.get('first_name'),
-                sender.get('username'),
-                chat_id
-            )
+            return None, None, message, callback_query
 
-        if message and message.get('text') == '/start':
-            await self.finalize(customer['id'])
-            await tgclient.api_call(
-                method_name='sendPhoto',
-                payload={
-                    'chat_id': chat_id,
-                    'caption': '*Что умеет этот бот?*\n\n'
-                               'Подбор музыки, соответствующей текущему эмоциональному состоянию пользователя '
-                               'Генерация мелодии на основе заданного настроения и предпочтений пользователя',
-                    'photo': 'https://art.ttshop.kz/static/uploads/78/cf/78cf9c70-7622-4800-b97d-f6b52de3a176.jpeg',
-                    'parse_mode': 'Markdown',
-                    'reply_markup': {
-                        'keyboard': MENU_BUTTONS,
-                        'one_time_keyboard': True,
-                        'resize_keyboard': True
-                    }
-                }
-            )
-
-            await tgclient.api_call(
-                method_name='sendMessage',
-                payload={
-                    'chat_id': chat_id,
-                    'text': 'Привет! Меня зовут TulparIfy. '
-                            'Я здесь, чтобы помочь тебе с помощью арт-терапии через музыку.'
-                            'Как тебя зовут?',
-                    'reply_markup': {
-                        'keyboard': [HOME_BUTTON],
-                        'one_time_keyboard': True,
-                        'resize_keyboard': True
-                    }
-                }
-            )
-            await cache.setex(f'art:question:name:{customer["id"]}', 600, '1')
-
-            return response.json({})
+        return chat_id or None, sender, message, callback_query
 
+    async def dispatch(self, chat_id, customer, state, message, callback_query):
         text = None
-        success = False
-        questions = None
 
         if message and message.get('text'):
             text = message['text']
+            if text == '/start':
+                return await self.on_start(chat_id, customer, state, text)
 
         if callback_query and callback_query.get('data'):
             text = callback_query['data']
-            if text:
-                if text.startswith('playlist'):
-                    _, r, _id = text.split(':')
-                    if r == 'id':
-                        await self.get_playlist(chat_id, _id)
-                        return response.json({})
-                    elif r == 'page':
-                        await self.playlists(customer['id'], chat_id, _id)
-                        return response.json({})
-
-        if text and text.startswith('🏠'):
-            await self.finalize(customer['id'])
-            await tgclient.api_call(
+            handler = self.CALLBACKS.get(text.split(':', 1)[0])
+            if handler:
+                return await getattr(self, handler)(chat_id, customer, state, text)
+
+        handler = self.BUTTONS.get(text[:1]) if text else None
+        if handler is None:
+            handler = self.STATES.get(state.current, 'on_text')
+
+        return await getattr(self, handler)(chat_id, customer, state, text)
+
+    async def on_start(self, chat_id, customer, state, text):
+        self.finalize(state)
+        await outbox.send(
+            method_name='sendPhoto',
+            payload={
+                'chat_id': chat_id,
+                'caption': '*Что умеет этот бот?*\n\n'
+                           'Подбор музыки, соответствующей текущему эмоциональному состоянию пользователя '
+                           'Генерация мелодии на основе заданного настроения и предпочтений пользователя',
+                'photo': 'https://art.ttshop.kz/static/uploads/78/cf/78cf9c70-7622-4800-b97d-f6b52de3a176.jpeg',
+                'parse_mode': 'Markdown',
+                'reply_markup': {
+                    'keyboard': MENU_BUTTONS,
+                    'one_time_keyboard': True,
+                    'resize_keyboard': True
+                }
+            }
+        )
+
+        await outbox.send(
+            method_name='sendMessage',
+            payload={
+                'chat_id': chat_id,
+                'text': 'Привет! Меня зовут TulparIfy. '
+                        'Я здесь, чтобы помочь тебе с помощью арт-терапии через музыку.'
+                        'Как тебя зовут?',
+                'reply_markup': {
+                    'keyboard': [HOME_BUTTON],
+                    'one_time_keyboard': True,
+                    'resize_keyboard': True
+                }
+            }
+        )
+        state.transition('name')
+
+    async def on_playlist(self, chat_id, customer, state, text):
+        _, r, _id = text.split(':')
+        if r == 'id':
+            await self.get_playlist(chat_id, _id)
+        elif r == 'after' or r == 'before':
+            await self.playlists(customer['id'], chat_id, r, _id)
+        elif r == 'page':  # кнопки старых сообщений со смещением
+            await self.playlists(customer['id'], chat_id)
+
+    async def on_home(self, chat_id, customer, state, text):
+        self.finalize(state)
+        await outbox.send(
+            payload={
+                'chat_id': chat_id,
+                'text': 'Выберите',
+                'reply_markup': {
+                    'keyboard': MENU_BUTTONS,
+                    'one_time_keyboard': True,
+                    'resize_keyboard': True
+                }
+            }
+        )
+
+    async def on_music(self, chat_id, customer, state, text):
+        await outbox.send(
+            payload={
+                'chat_id': chat_id,
+                'text': 'Выберите',
+                'reply_markup': {
+                    'keyboard': [[{'text': '🛠️ Выбор параметров'}], [{'text': '🔎 Генерация трека'}], HOME_BUTTON],
+                    'one_time_keyboard': True,
+                    'resize_keyboard': True
+                }
+            }
+        )
+
+    async def on_ai_questions(self, chat_id, customer, state, text):
+        self.finalize(state)
+        await self.generate_questions(state, 'ai')
+        state.transition('questions')
+        await self.ask(chat_id, state, None, None)
+
+    async def on_search_questions(self, chat_id, customer, state, text):
+        self.finalize(state)
+        await self.generate_questions(state, 'search')
+        state.transition('questions')
+        await self.ask(chat_id, state, None, None)
+
+    async def on_playlists(self, chat_id, customer, state, text):
+        await self.playlists(customer['id'], chat_id)
+
+    async def on_audio_name(self, chat_id, customer, state, text):
+        state.transition('audio_name')
+        await outbox.send(
+            method_name='sendMessage',
+            payload={
+                'chat_id': chat_id,
+                'text': 'Напишите название трека',
+                'reply_markup': {
+                    'keyboard': [HOME_BUTTON],
+                    'one_time_keyboard': True,
+                    'resize_keyboard': True
+                }
+            }
+        )
+
+    async def on_audio_title(self, chat_id, customer, state, text):
+        playlist_id = IntUtils.to_int(state.get('audio'))
+        if playlist_id:
+            t = 'Сохранено'
+            await writer.write(RENAME_PLAYLIST, playlist_id, text)
+        else:
+            t = 'Ничего не найден'
+
+        await outbox.send(
+            method_name='sendMessage',
+            payload={
+                'chat_id': chat_id,
+                'text': t,
+                'reply_markup': {
+                    'keyboard': [HOME_BUTTON],
+                    'one_time_keyboard': True,
+                    'resize_keyboard': True
+                }
+            }
+        )
+
+        state.transition(None)
+        state.delete('audio')
+
+    async def on_generate(self, chat_id, customer, state, text):
+        await self.generate_turn(state, chat_id)
+        self.finalize(state)
+
+    async def on_rating(self, chat_id, customer, state, text):
+        lemmas = await lemmatizer.lemmatize(text)
+        success = True
+        if risk_matcher.match(lemmas):
+            if state.get('risk'):
+                await outbox.send(
+                    payload={
+                        'chat_id': chat_id,
+                        'text': 'Рекомендую обратиться к профессиональному психологу или психотерапевту,'
+                                ' если это беспокоит длительное время. Арт-терапия может быть эффективным '
+                                'дополнением к другим методам лечения депрессии, таким как медикаментозная '
+                                'терапия и психотерапия',
+                        'reply_markup': {
+                            'keyboard': [HOME_BUTTON],
+                            'one_time_keyboard': True,
+                            'resize_keyboard': True
+                        }
+                    }
+                )
+                success = False
+
+        if success:
+            await outbox.send(
+                method_name='sendMessage',
                 payload={
                     'chat_id': chat_id,
-                    'text': 'Выберите',
+                    'text': 'Спасибо за вашу обратную связь!',
                     'reply_markup': {
                         'keyboard': MENU_BUTTONS,
                         'one_time_keyboard': True,
@@ -431,152 +641,157 @@ class TelegramWebhookHandler(HTTPMethodView):
                     }
                 }
             )
+        self.finalize(state)
 
-            return response.json({})
+    async def on_locale_tune(self, chat_id, customer, state, text):
+        await self.send_rating(state, chat_id, text)
 
-        elif text and text.startswith('🎼'):
-            await tgclient.api_call(
-                payload={
-                    'chat_id': chat_id,
-                    'text': 'Выберите',
-                    'reply_markup': {
-                        'keyboard': [[{'text': '🛠️ Выбор параметров'}], [{'text': '🔎 Генерация трека'}], HOME_BUTTON],
-                        'one_time_keyboard': True,
-                        'resize_keyboard': True
-                    }
+    async def on_name(self, chat_id, customer, state, text):
+        state.transition(None)
+
+        await writer.write(RENAME_CUSTOMER, customer['id'], text)
+
+        await outbox.send(
+            method_name='sendMessage',
+            payload={
+                'chat_id': chat_id,
+                'text': 'Выберите',
+                'reply_markup': {
+                    'keyboard': MENU_BUTTONS,
+                    'one_time_keyboard': True,
+                    'resize_keyboard': True
                 }
-            )
+            }
+        )
 
-            return response.json({})
+    async def on_answer(self, chat_id, customer, state, text):
+        has_next = (state.get('cursor') or 0) < len(state.get('queue') or [])
+        prev_question = await self.prev_question(state)
 
-        elif text and text.startswith('🛠'):
-            await self.finalize(customer['id'])
-            questions = await self.generate_questions(customer['id'], 'ai')
+        if not text or (not has_next and not prev_question):
+            return await self.on_text(chat_id, customer, state, text)
 
-        elif text and text.startswith('💬'):
-            await self.finalize(customer['id'])
-            questions = await self.generate_questions(customer['id'], 'search')
+        question = None
+        if prev_question:
+            if prev_question['buttons']:
+                question = prev_question
+                for x in prev_question['buttons']:
+                    if text == x['text']:
+                        question = None
+                        state.set('words', (state.get('words') or []) + [x['callback_data']])
 
-        elif text and text.startswith('📁'):
-            await self.playlists(customer['id'], chat_id)
-            return response.json({})
+            lemmas = await lemmatizer.lemmatize(text)  # поиск основы слов
 
-        elif text and text.startswith('\u2069'):
-            await cache.setex(f'art:telegram:audio:name:{customer["id"]}', 600, '1')
-            await tgclient.api_call(
-                method_name='sendMessage',
-                payload={
-                    'chat_id': chat_id,
-                    'text': 'Напишите название трека',
+            if risk_matcher.match(lemmas):
+                state.set('risk', 1)
+                await self.send_locale_tune(state, chat_id)
+                return
+
+        await self.ask(chat_id, state, prev_question, question)
+
+    async def ask(self, chat_id, state, prev_question, question):  # Отправка следующего вопроса
+        if not question:
+            question = await self.next_question(state)
+
+        payload, end = {'chat_id': chat_id}, False
+
+        if question:
+            state.set('prev_question', question['id'])
+            payload['text'] = question['text']
+
+        else:
+            end = True
+
+        if end:
+            if prev_question and prev_question.get('is_last'):
+                await self.send_locale_tune(state, chat_id)
+                return
+            else:
+                payload.update({
+                    'text': 'Выберите',
                     'reply_markup': {
-                        'keyboard': [HOME_BUTTON],
+                        'keyboard': [[{'text': '🔎 Генерировать трек'}], HOME_BUTTON],
                         'one_time_keyboard': True,
                         'resize_keyboard': True
                     }
+                })
+
+        elif question and question['buttons']:
+            payload.update({
+                'reply_markup': {
+                    'keyboard': [
+                        [{
+                            'text': button['text'],
+                        }] for button in question['buttons'] + HOME_BUTTON
+                    ],
+                    'one_time_keyboard': True,
+                    'resize_keyboard': True
                 }
-            )
-            return response.json({})
-
-        elif await cache.get(f'art:telegram:audio:name:{customer["id"]}'):
-            playlist_id = IntUtils.to_int(await cache.get(f'art:telegram:audio:{customer["id"]}'))
-            if playlist_id:
-                t = 'Сохранено'
-                await db.fetchrow(
-                    '''
-                    UPDATE public.playlist
-                    SET status = 3, title = $2
-                    WHERE id = $1
-                    ''',
-                    playlist_id,
-                    text
-                )
-            else:
-                t = 'Ничего не найден'
+            })
+        else:
+            payload.update({
+                'reply_markup': {
+                    'keyboard': [HOME_BUTTON],
+                    'one_time_keyboard': True,
+                    'resize_keyboard': True
+                }
+            })
 
-            await tgclient.api_call(
-                method_name='sendMessage',
+        await outbox.send(method_name='sendMessage', payload=payload)
+
+    async def on_reference(self, chat_id, customer, state, text):
+        buttons = await db.fetchval(KBASE_REFERENCES)
+        await outbox.send(
+            payload={
+                'chat_id': chat_id,
+                'text': 'Выберите',
+                'reply_markup': {
+                    'keyboard': [[{'text': x}] for x in buttons] + [HOME_BUTTON],
+                    'one_time_keyboard': True,
+                    'resize_keyboard': True
+                }
+            }
+        )
+
+    async def on_about(self, chat_id, customer, state, text):
+        await outbox.send(
+            method_name='sendPhoto',
+            payload={
+                'chat_id': chat_id,
+                'caption': '*Что умеет этот бот?*\n\n'
+                           'Подбор музыки, соответствующей текущему эмоциональному состоянию пользователя '
+                           'Генерация мелодии на основе заданного настроения и предпочтений пользователя',
+                'photo': 'https://art.ttshop.kz/static/uploads/78/cf/78cf9c70-7622-4800-b97d-f6b52de3a176.jpeg',
+                'parse_mode': 'Markdown',
+                'reply_markup': {
+                    'keyboard': MENU_BUTTONS,
+                    'one_time_keyboard': True,
+                    'resize_keyboard': True
+                }
+            }
+        )
+
+    async def on_text(self, chat_id, customer, state, text):  # Поиск ответа в базе знаний
+        kbase = await db.fetchrow(KBASE_BY_TITLE, text)
+        if kbase:
+            await outbox.send(
                 payload={
                     'chat_id': chat_id,
-                    'text': t,
+                    'text': kbase['response'],
+                    'parse_mode': 'Markdown',
                     'reply_markup': {
-                        'keyboard': [HOME_BUTTON],
+                        'keyboard': MENU_BUTTONS,
                         'one_time_keyboard': True,
                         'resize_keyboard': True
                     }
                 }
             )
 
-            await cache.delete(f'art:telegram:audio:name:{customer["id"]}', f'art:telegram:audio:{customer["id"]}')
-
-            return response.json({})
-
-        elif text and text.startswith('🔎'):
-            await self.generate_turn(customer['id'], chat_id)
-            await self.finalize(customer['id'])
-
-            return response.json({})
-
-        elif await cache.get(f'art:telegram:questions:rating:{customer["id"]}'):
-            lemmas = m.lemmatize(text)
-            success = True
-            for x in RISK_WORDS:
-                if len(list(set(x) & set(lemmas))) == len(x):
-                    if await cache.get(f'art:telegram:risk:{customer["id"]}'):
-                        await tgclient.api_call(
-                            payload={
-                                'chat_id': chat_id,
-                                'text': 'Рекомендую обратиться к профессиональному психологу или психотерапевту,'
-                                        ' если это беспокоит длительное время. Арт-терапия может быть эффективным '
-                                        'дополнением к другим методам лечения депрессии, таким как медикаментозная '
-                                        'терапия и психотерапия',
-                                'reply_markup': {
-                                    'keyboard': [HOME_BUTTON],
-                                    'one_time_keyboard': True,
-                                    'resize_keyboard': True
-                                }
-                            }
-                        )
-                        success = False
-                    break
-
-            if success:
-                await tgclient.api_call(
-                    method_name='sendMessage',
-                    payload={
-                        'chat_id': chat_id,
-                        'text': 'Спасибо за вашу обратную связь!',
-                        'reply_markup': {
-                            'keyboard': MENU_BUTTONS,
-                            'one_time_keyboard': True,
-                            'resize_keyboard': True
-                        }
-                    }
-                )
-            await self.finalize(customer['id'])
-            return response.json({})
-
-        elif await cache.get(f'art:telegram:locale_tune:{customer["id"]}'):
-            await self.send_rating(customer['id'], chat_id, text)
-            return response.json({})
-
-        if await cache.get(f'art:question:name:{customer["id"]}'):
-            await cache.delete(f'art:question:name:{customer["id"]}')
-
-            await db.execute(
-                '''
-                UPDATE public.customers
-                SET name = $2
-                WHERE id = $1
-                ''',
-                customer['id'],
-                text
-            )
-
-            await tgclient.api_call(
-                method_name='sendMessage',
+        else:
+            await outbox.send(
                 payload={
                     'chat_id': chat_id,
-                    'text': 'Выберите',
+                    'text': 'В системе ничего не найдено',
                     'reply_markup': {
                         'keyboard': MENU_BUTTONS,
                         'one_time_keyboard': True,
@@ -584,175 +799,3 @@ class TelegramWebhookHandler(HTTPMethodView):
                     }
                 }
             )
-
-            return response.json({})
-
-        if not questions:
-            questions = await cache.get(f'art:telegram:questions:{customer["id"]}')
-            if questions:
-                questions = ujson.loads(questions)
-
-        if text:
-            success, method = True, 'sendMessage'
-            while success:
-                prev_question = await cache.get(f'art:telegram:prev_question:{customer["id"]}')
-
-                if questions:
-                    pass
-                elif not prev_question:
-                    success = False
-                    continue
-
-                question, genre = None, None
-                if prev_question:
-                    prev_question = ujson.loads(prev_question)
-                    if prev_question['buttons']:
-                        question = prev_question
-                        for x in prev_question['buttons']:
-                            if text == x['text']:
-                                question = None
-                                genre = x['callback_data']
-                                await cache.lpush(f'art:telegram:words:{customer["id"]}', genre)
-
-                    lemmas = m.lemmatize(text)  # поиск основы слов
-
-                    for x in RISK_WORDS:
-                        if len(list(set(x) & set(lemmas))) == len(x):
-                            await cache.setex(f'art:telegram:risk:{customer["id"]}', 600, 1)
-                            await self.send_locale_tune(customer['id'], chat_id)
-
-                            return response.json({})
-
-                if not question:
-                    question = questions.pop(0) if questions else {}
-
-                payload, end = {'chat_id': chat_id}, False
-
-                if question:
-                    await cache.setex(f'art:telegram:prev_question:{customer["id"]}', 600, ujson.dumps(question))
-                    await cache.setex(f'art:telegram:questions:{customer["id"]}', 600, ujson.dumps(questions))
-                    payload['text'] = question['text']
-
-                else:
-                    end = True
-
-                if end:
-                    if prev_question and prev_question.get('is_last'):
-                        await self.send_locale_tune(customer['id'], chat_id)
-                        return response.json({})
-                    else:
-                        payload.update({
-                            'text': 'Выберите',
-                            'reply_markup': {
-                                'keyboard': [[{'text': '🔎 Генерировать трек'}], HOME_BUTTON],
-                                'one_time_keyboard': True,
-                                'resize_keyboard': True
-                            }
-                        })
-
-                elif question and question['buttons']:
-                    payload.update({
-                        'reply_markup': {
-                            'keyboard': [
-                                [{
-                                    'text': button['text'],
-                                }] for button in question['buttons'] + HOME_BUTTON
-                            ],
-                            'one_time_keyboard': True,
-                            'resize_keyboard': True
-                        }
-                    })
-                else:
-                    payload.update({
-                        'reply_markup': {
-                            'keyboard': [HOME_BUTTON],
-                            'one_time_keyboard': True,
-                            'resize_keyboard': True
-                        }
-                    })
-
-                await tgclient.api_call(method_name=method, payload=payload)
-                break
-
-        if success is False:
-            if text and text.startswith('📃️'):
-                buttons = await db.fetchval(
-                    '''
-                    WITH a AS (SELECT title
-                               FROM public.kbase
-                               WHERE type = 'reference'
-                               ORDER BY id)
-                    SELECT array_agg(title)
-                    FROM a
-                    '''
-                )
-                await tgclient.api_call(
-                    payload={
-                        'chat_id': chat_id,
-                        'text': 'Выберите',
-                        'reply_markup': {
-                            'keyboard': [[{'text': x}] for x in buttons] + [HOME_BUTTON],
-                            'one_time_keyboard': True,
-                            'resize_keyboard': True
-                        }
-                    }
-                )
-
-                return response.json({})
-
-            elif text and text.startswith('ℹ️'):
-                await tgclient.api_call(
-                    method_name='sendPhoto',
-                    payload={
-                        'chat_id': chat_id,
-                        'caption': '*Что умеет этот бот?*\n\n'
-                                   'Подбор музыки, соответствующей текущему эмоциональному состоянию пользователя '
-                                   'Генерация мелодии на основе заданного настроения и предпочтений пользователя',
-                        'photo': 'https://art.ttshop.kz/static/uploads/78/cf/78cf9c70-7622-4800-b97d-f6b52de3a176.jpeg',
-                        'parse_mode': 'Markdown',
-                        'reply_markup': {
-                            'keyboard': MENU_BUTTONS,
-                            'one_time_keyboard': True,
-                            'resize_keyboard': True
-                        }
-                    }
-                )
-
-                return response.json({})
-
-            kbase = await db.fetchrow(
-                '''
-                SELECT *
-                FROM public.kbase
-                WHERE title = $1
-                ''',
-                text
-            )
-            if kbase:
-                await tgclient.api_call(
-                    payload={
-                        'chat_id': chat_id,
-                        'text': kbase['response'],
-                        'parse_mode': 'Markdown',
-                        'reply_markup': {
-                            'keyboard': MENU_BUTTONS,
-                            'one_time_keyboard': True,
-                            'resize_keyboard': True
-                        }
-                    }
-                )
-
-            else:
-                await tgclient.api_call(
-                    payload={
-                        'chat_id': chat_id,
-                        'text': 'В системе ничего не найдено',
-                        'reply_markup': {
-                            'keyboard': MENU_BUTTONS,
-                            'one_time_keyboard': True,
-                            'resize_keyboard': True
-                        }
-                    }
-                )
-
-        return response.json({})